@@ -0,0 +1,69 @@
+import os
+import json
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger('PrideData')
+
+# accessions remembered per query, the project list is ordered by publication
+# date and a listed project is recognized by its accession only
+DISCOVERY_HISTORY = 1000
+
+
+class DiscoveryState(object):
+    """
+    Remembers the most recently listed accessions of each project list query.
+    New accessions are only written by commit, after the projects are processed.
+    """
+
+    def __init__(self, path, history=DISCOVERY_HISTORY):
+        self.path = path
+        self.history = history
+        self._accessions = dict()
+        self._pending = dict()
+
+        if os.path.exists(path):
+            with open(path, 'r') as fp:
+                self._accessions = json.load(fp)
+
+    def seen(self, query):
+        """
+        Returns the accessions listed for a query by previous runs.
+        """
+        return set(self._accessions.get(query, []))
+
+    def record(self, query, accessions):
+        """
+        Records accessions listed for a query, newest first.
+        """
+        self._pending.setdefault(query, []).extend(accessions)
+
+    def commit(self, incomplete=()):
+        """
+        Writes the recorded accessions in front of the remembered ones.
+
+        Parameters
+        ----------
+        incomplete: iterable
+            accessions of projects whose files were not all downloaded. They
+            and every accession listed before them are not remembered, the
+            next run pages down to them again.
+        """
+        if not self._pending:
+            return
+
+        incomplete = set(incomplete)
+        for query, accessions in self._pending.items():
+            last = max((index for index, accession in enumerate(accessions) if accession in incomplete), default=-1)
+            merged = accessions[last + 1:] + self._accessions.get(query, [])
+            self._accessions[query] = list(OrderedDict.fromkeys(merged))[:self.history]
+        self._pending = dict()
+
+        folder = os.path.dirname(self.path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        with open(self.path + '.tmp', 'w') as fp:
+            json.dump(fp=fp, obj=self._accessions)
+        os.replace(self.path + '.tmp', self.path)
+        log.info("Discovered accessions written to {}".format(self.path))
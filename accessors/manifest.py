@@ -0,0 +1,157 @@
+import os
+import csv
+import time
+import logging
+import sqlite3
+
+log = logging.getLogger('PrideData')
+
+# processing states of a file tuple, later states imply the earlier ones
+DISCOVERED = 0
+DOWNLOADED = 1
+EXTRACTED = 2
+FEATURIZED = 3
+WRITTEN = 4
+
+STATES = ('discovered', 'downloaded', 'extracted', 'featurized', 'written')
+
+
+class Manifest(object):
+    """
+    Indexed manifest of the file tuples of all projects and their processing state.
+    A tuple is identified by its project and the urls of its mgf and mzid,
+    the local paths are recorded once the tuple is downloaded.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+
+        self._connection = sqlite3.connect(path)
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'project TEXT NOT NULL, mgf_url TEXT NOT NULL, mzid_url TEXT NOT NULL, '
+            'mgf TEXT, mzid TEXT, state INTEGER NOT NULL, updated REAL NOT NULL, '
+            'PRIMARY KEY (project, mgf_url, mzid_url))')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS files_project_state ON files (project, state)')
+        self._connection.commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self._connection.close()
+
+    def set_state(self, project, mgf_url, mzid_url, state, mgf=None, mzid=None):
+        """
+        Records the state of a file tuple, local paths are kept if not given.
+
+        Parameters
+        ----------
+        project: str
+            PRIDE project accession
+        mgf_url: str
+            source url of the mgf
+        mzid_url: str
+            source url of the mzid
+        state: int
+            processing state of the tuple
+        mgf: str
+            local path of the mgf
+        mzid: str
+            local path of the mzid
+
+        """
+        self._connection.execute(
+            'INSERT INTO files (project, mgf_url, mzid_url, mgf, mzid, state, updated) VALUES (?, ?, ?, ?, ?, ?, ?) '
+            'ON CONFLICT (project, mgf_url, mzid_url) DO UPDATE SET '
+            'mgf = COALESCE(excluded.mgf, mgf), mzid = COALESCE(excluded.mzid, mzid), '
+            'state = excluded.state, updated = excluded.updated',
+            (project, mgf_url, mzid_url, mgf, mzid, state, time.time()))
+        self._connection.commit()
+
+    def set_file_state(self, project, mgf, mzid, state):
+        """
+        Records the state of a file tuple identified by its local paths.
+        """
+        self._connection.execute(
+            'UPDATE files SET state = ?, updated = ? WHERE project = ? AND mgf = ? AND mzid = ?',
+            (state, time.time(), project, mgf, mzid))
+        self._connection.commit()
+
+    def state(self, project, mgf_url, mzid_url):
+        """
+        Returns the state of a file tuple or None if it is unknown.
+        """
+        row = self._connection.execute(
+            'SELECT state FROM files WHERE project = ? AND mgf_url = ? AND mzid_url = ?',
+            (project, mgf_url, mzid_url)).fetchone()
+        return row[0] if row else None
+
+    def incomplete_projects(self, projects, state=EXTRACTED):
+        """
+        Returns the projects with a file tuple which did not reach a state.
+        """
+        projects = set(projects)
+        rows = self._connection.execute('SELECT DISTINCT project FROM files WHERE state < ?', (state,)).fetchall()
+        return set(row[0] for row in rows if row[0] in projects)
+
+    def files(self, projects=None, state=EXTRACTED):
+        """
+        Lists the local file tuples which reached a state.
+
+        Parameters
+        ----------
+        projects: list
+            restricts the tuples to these projects
+        state: int
+            minimal processing state of the tuples
+
+        Returns
+        -------
+        list
+            (project, mgf, mzid) tuples in the order they were recorded
+
+        """
+        rows = self._connection.execute(
+            'SELECT project, mgf, mzid FROM files WHERE state >= ? ORDER BY rowid', (state,)).fetchall()
+        if projects is not None:
+            projects = set(projects)
+            rows = [row for row in rows if row[0] in projects]
+        return [tuple(row) for row in rows]
+
+    def import_archive(self, archivePath):
+        """
+        Imports the file tuples of a legacy archive csv as extracted tuples.
+
+        Parameters
+        ----------
+        archivePath: str
+            path of the archive csv
+
+        Returns
+        -------
+        int
+            number of imported tuples
+
+        """
+        if not os.path.exists(archivePath):
+            return 0
+
+        imported = 0
+        with open(archivePath, 'r') as fp:
+            for row in csv.reader(fp, delimiter=';'):
+                if len(row) >= 3:
+                    self._connection.execute(
+                        'INSERT OR IGNORE INTO files (project, mgf_url, mzid_url, mgf, mzid, state, updated) '
+                        'VALUES (?, ?, ?, ?, ?, ?, ?)', (row[0], row[1], row[2], row[1], row[2], EXTRACTED, time.time()))
+                    imported += 1
+        self._connection.commit()
+        log.info("Imported {} file tuples from {}".format(imported, archivePath))
+        return imported
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import hashlib
+import logging
+import threading
+
+import requests
+
+log = logging.getLogger('PrideData')
+
+# project list pages change with every new submission, their cached
+# responses are revalidated on each request instead of being served for the ttl
+REVALIDATED_URLS = ('/project/list',)
+
+
+class MetadataCache(object):
+    """
+    Persistent cache of PRIDE web service responses keyed by url.
+    Entries younger than the ttl are served without a request, older entries
+    and project list pages are revalidated with ETag/If-Modified-Since. The
+    least recently used entries are evicted once the cache exceeds its size.
+    """
+
+    def __init__(self, folder, ttl=86400, max_size=256 * 1024 * 1024, offline=False):
+        self.folder = folder
+        self.ttl = ttl
+        self.max_size = max_size
+        self.offline = offline
+        self._lock = threading.Lock()
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def _paths(self, url):
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.folder, key + '.json'), os.path.join(self.folder, key + '.meta')
+
+    def lookup(self, url):
+        """
+        Reads a cached response.
+
+        Parameters
+        ----------
+        url: str
+            requested url
+
+        Returns
+        -------
+        tuple
+            decoded response and its metadata, (None, None) if the url is not cached
+
+        """
+        data_path, meta_path = self._paths(url)
+        try:
+            with open(meta_path, 'r') as fp:
+                meta = json.load(fp)
+            with open(data_path, 'r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return None, None
+        return data, meta
+
+    def store(self, url, data, headers):
+        """
+        Writes a response to the cache and evicts old entries.
+
+        Parameters
+        ----------
+        url: str
+            requested url
+        data: dict
+            decoded response
+        headers: dict
+            response headers
+
+        """
+        data_path, meta_path = self._paths(url)
+        meta = {'url': url, 'fetched': time.time(),
+                'etag': headers.get('ETag'), 'last_modified': headers.get('Last-Modified')}
+
+        with open(data_path + '.tmp', 'w') as fp:
+            json.dump(fp=fp, obj=data)
+        os.replace(data_path + '.tmp', data_path)
+        self._write_meta(meta_path, meta)
+        self.evict()
+
+    def _write_meta(self, meta_path, meta):
+        with open(meta_path + '.tmp', 'w') as fp:
+            json.dump(fp=fp, obj=meta)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def _touch(self, url):
+        data_path, _ = self._paths(url)
+        try:
+            os.utime(data_path)
+        except OSError:
+            pass
+
+    def evict(self):
+        """
+        Removes least recently used entries until the cache fits its size.
+        """
+        with self._lock:
+            entries = []
+            total = 0
+            for name in os.listdir(self.folder):
+                if not name.endswith('.json'):
+                    continue
+                data_path = os.path.join(self.folder, name)
+                meta_path = data_path[:-5] + '.meta'
+                try:
+                    size = os.path.getsize(data_path) + os.path.getsize(meta_path)
+                    entries.append((os.path.getmtime(data_path), size, data_path, meta_path))
+                except OSError:
+                    continue
+                total += size
+
+            for _, size, data_path, meta_path in sorted(entries):
+                if total <= self.max_size:
+                    break
+                for path in (data_path, meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                total -= size
+
+    def _ttl(self, url):
+        if any(pattern in url for pattern in REVALIDATED_URLS):
+            return 0
+        return self.ttl
+
+    def get(self, url, session):
+        """
+        Returns the response for a url from the cache or the web service.
+
+        Parameters
+        ----------
+        url: str
+            requested url
+        session: requests.Session
+            session used for requests
+
+        Returns
+        -------
+        dict
+            decoded response or None if it is neither cached nor available
+
+        """
+        data, meta = self.lookup(url)
+
+        if data is not None and (self.offline or time.time() - meta['fetched'] < self._ttl(url)):
+            self._touch(url)
+            return data
+
+        if self.offline:
+            log.warning("Offline mode: {} is not cached!".format(url))
+            return None
+
+        headers = dict()
+        if meta and meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta and meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+        try:
+            response = session.get(url, headers=headers, timeout=60)
+
+            if response.status_code == 304 and data is not None:
+                meta['fetched'] = time.time()
+                self._write_meta(self._paths(url)[1], meta)
+                self._touch(url)
+                return data
+
+            if not response:
+                raise requests.HTTPError("Request to {} failed with status {}!".format(url, response.status_code))
+
+            response_data = response.json()
+        except (requests.RequestException, ValueError):
+            if data is not None:
+                log.warning("Request to {} failed, using the cached response!".format(url))
+                return data
+            raise
+
+        self.store(url, response_data, response.headers)
+        return response_data
@@ -3,16 +3,139 @@ import json
 import os
 import csv
 import gzip
-import urllib
+import urllib.request
+import urllib.error
 import shutil
 import logging
 import requests
 import time
 import datetime
+import threading
+
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+
+from accessors.manifest import DISCOVERED, DOWNLOADED, EXTRACTED
+from accessors.scheduler import DownloadScheduler
+from accessors.transfer import PartialManifest, RangeError, TRANSFER_ERRORS, TRANSFER_TIMEOUT, open_stream, remote_size
 
 log = logging.getLogger('PrideData')
 
-def get_projectlist(args):
+# size of the blocks streamed from the network to disk
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# number of chunks written between two updates of a partial file manifest
+MANIFEST_INTERVAL = 16
+# number of concurrent requests to the PRIDE web service
+METADATA_WORKERS = 8
+
+_session = None
+_session_lock = threading.Lock()
+_metadata_cache = None
+
+
+def get_session():
+    """
+    Returns the pooled keep-alive session shared by all PRIDE web service requests.
+
+    Returns
+    -------
+    requests.Session
+        shared session
+
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=2, pool_maxsize=METADATA_WORKERS)
+            _session.mount('https://', adapter)
+            _session.mount('http://', adapter)
+        return _session
+
+
+def set_metadata_cache(cache):
+    """
+    Sets the cache consulted by all PRIDE web service requests.
+
+    Parameters
+    ----------
+    cache : MetadataCache
+        cache of web service responses, None disables caching
+
+    """
+    global _metadata_cache
+    _metadata_cache = cache
+
+
+def request_json(url):
+    """
+    Requests a json document from the PRIDE web service or the metadata cache.
+
+    Parameters
+    ----------
+    url : str
+        web service url
+
+    Returns
+    -------
+    dict
+        decoded response or None if the request failed
+
+    """
+    log.info("Requested URL: %s", url)
+    try:
+        if _metadata_cache is not None:
+            return _metadata_cache.get(url, get_session())
+
+        response = get_session().get(url, timeout=60)
+        if not response:
+            log.error("Request to {} failed with status {}!".format(url, response.status_code))
+            return None
+        return response.json()
+    except (requests.RequestException, ValueError) as err:
+        log.error(err)
+        log.error("Request to {} could not be decoded!".format(url))
+        return None
+
+
+def _fetch_new_pages(urls, query, discovery):
+    """
+    Requests project list pages one after another until a page lists a
+    project that was listed by a previous run.
+
+    Returns
+    -------
+    list
+        responses containing only the new projects of each page
+
+    """
+    seen = discovery.seen(query)
+    responses = []
+
+    for url in urls:
+        response = request_json(url)
+        if not response:
+            responses.append(response)
+            break
+
+        page_projects = response['list']
+
+        new_projects = []
+        for project in page_projects:
+            if project['accession'] in seen:
+                break
+            new_projects.append(project)
+        discovery.record(query, [project['accession'] for project in new_projects])
+        responses.append({'list': new_projects})
+
+        if len(new_projects) < len(page_projects) or not page_projects:
+            log.info("Reached previously discovered projects after {} pages!".format(len(responses)))
+            break
+
+    return responses
+
+
+def get_projectlist(args, discovery=None):
     """
     Returns a projectlist containing all valid project accessions.
     
@@ -20,6 +143,8 @@ def get_projectlist(args):
     ----------
     args : list
         programm execution arguments
+    discovery : DiscoveryState
+        stops requesting pages once previously processed projects are listed
 
     Returns
     -------
@@ -32,26 +157,28 @@ def get_projectlist(args):
     project_list = []
     urls = []
 
+    query = None
+
     if args.accessions:
         for acc in args.accessions:
             url = "https://www.ebi.ac.uk:443/pride/ws/archive/project/" + ''.join(acc)
             urls.append(url)
 
     else:
+        query = 'https://www.ebi.ac.uk:443/pride/ws/archive/project/list/?show=' + \
+            str(args.number) + '&page={}&order=desc'
+        if args.species:
+            query += '&speciesFilter='
+            for spec in args.species:
+                query += spec + '%2C%20'
+            query = query[:-6]
+        if args.instruments:
+            query += '&instrumentFilter='
+            for ins in args.instruments:
+                query += ins + '%2C%20'
+            query = query[:-6]
         for page in range(0, args.pages):
-            url = 'https://www.ebi.ac.uk:443/pride/ws/archive/project/list/?show=' + \
-                str(args.number) + '&page=' + str(page) + '&order=desc'
-            if args.species:
-                url += '&speciesFilter='
-                for spec in args.species:
-                    url += spec + '%2C%20'
-                url = url[:-6]
-            if args.instruments:
-                url += '&instrumentFilter='
-                for ins in args.instruments:
-                    url += ins + '%2C%20'
-                url = url[:-6]
-            urls.append(url)
+            urls.append(query.format(page))
 
     projectList = []
     projectDescriptions = dict()
@@ -62,15 +189,18 @@ def get_projectlist(args):
         for row in modification_csv:
             modifications[row[0]] = True if not '1' in row[1] else False
 
-    for url in urls:
-        log.info("Requested URL: %s", url)
-
-        responseList = requests.get(url)
-        
-        if responseList and not args.accessions:
-            project_list = responseList.json()['list']
-        elif args.accessions:
-            project_list = [responseList.json()]
+    if discovery is not None and query:
+        responses = _fetch_new_pages(urls, query, discovery)
+    else:
+        # pages are requested concurrently, map keeps the order of the urls
+        with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+            responses = list(executor.map(request_json, urls))
+
+    for response in responses:
+        if response and not args.accessions:
+            project_list = response['list']
+        elif response:
+            project_list = [response]
         else:
             log.error("No PRIDE server response received!")
             continue
@@ -127,14 +257,13 @@ def get_filelist(project):
     # Set the request URL
     url = 'https://www.ebi.ac.uk/pride/ws/archive/file/list/project/' + project
     # Request url and convert response to json
-    try:
-        log.info("Requesting filelist at {} !".format(url))
-        project_files = requests.get(url).json()['list']
-    except (json.decoder.JSONDecodeError, KeyError) as err:
-        log.error(err)
+    log.info("Requesting filelist at {} !".format(url))
+    response = request_json(url)
+    if not response or 'list' not in response:
         log.error("Request to {} could not be decoded!".format(url))
         log.error("Project at {} !".format(project))
         return None
+    project_files = response['list']
 
     for pfile in project_files:
         if 'downloadLink' in pfile:
@@ -159,9 +288,155 @@ def get_filelist(project):
     return files
 
 
-def download_file(url, dest_folder):
+def _fetch_segment(url, part_path, manifest, chunk_size, segment):
+    """ 
+    Fetches the missing bytes of a segment of a partial file.
+    """
+    start, end, received = segment
+    stream, honoured = open_stream(url, start + received, end)
+
+    with stream:
+        if not honoured:
+            if len(manifest.segments) > 1:
+                raise RangeError('Server ignored range request for {}'.format(url))
+            log.warning('Server ignored range request, restarting {}'.format(url))
+            manifest.advance(segment, -received)
+
+        with open(part_path, 'r+b') as f:
+            f.seek(start + segment[2])
+            if not honoured:
+                f.truncate()
+            chunks = 0
+            while end is None or start + segment[2] < end:
+                size = chunk_size if end is None else min(chunk_size, end - start - segment[2])
+                chunk = stream.read(size)
+                if not chunk:
+                    break
+                f.write(chunk)
+                manifest.advance(segment, len(chunk))
+                chunks += 1
+                if chunks % MANIFEST_INTERVAL == 0:
+                    f.flush()
+                    manifest.save()
+
+    if end is None:
+        # the size is only known once the stream ends
+        segment[1] = start + segment[2]
+        manifest.size = segment[1]
+    elif start + segment[2] < end:
+        raise EOFError('Transfer of {} ended after {} of {} bytes'.format(url, start + segment[2], end))
+
+
+def _fetch_resumable(url, part_path, chunk_size, segments):
+    """ 
+    Fetches a file into a partial file, continuing a previous transfer
+    recorded in the sidecar manifest of the partial file.
+
+    Returns
+    -------
+    int
+        number of bytes received by this call
+
+    """
+    manifest = PartialManifest.load(part_path + '.json', url) if os.path.exists(part_path) else None
+
+    if manifest:
+        log.info("Resuming {} at {} of {} bytes".format(url, manifest.received, manifest.size))
+    else:
+        manifest = PartialManifest.create(part_path + '.json', url, remote_size(url), segments)
+        open(part_path, 'wb').close()
+        manifest.save()
+
+    received = manifest.received
+    pending = manifest.pending
+
+    try:
+        if len(pending) > 1 and segments > 1:
+            # a resumed transfer opens no more connections than its scheduler slots allow
+            with ThreadPoolExecutor(max_workers=min(len(pending), segments)) as executor:
+                list(executor.map(partial(_fetch_segment, url, part_path, manifest, chunk_size), pending))
+        else:
+            for segment in pending:
+                _fetch_segment(url, part_path, manifest, chunk_size, segment)
+    except RangeError:
+        # segmented transfers need range support, fall back to a single connection
+        log.warning('Fetching {} over a single connection!'.format(url))
+        manifest.remove()
+        os.remove(part_path)
+        return _fetch_resumable(url, part_path, chunk_size, 1)
+    except TRANSFER_ERRORS:
+        manifest.save()
+        raise
+
+    if manifest.size is not None and os.path.getsize(part_path) != manifest.size:
+        manifest.remove()
+        os.remove(part_path)
+        raise OSError('Size of {} does not match the expected {} bytes'.format(part_path, manifest.size))
+
+    manifest.remove()
+    return manifest.received - received
+
+
+def _fetch_decompressed(url, part_path, chunk_size):
     """ 
-    Downloads a file.
+    Gunzips a remote file into a partial file while it arrives.
+    A gzip stream can not be continued, failed transfers start from scratch.
+
+    Returns
+    -------
+    int
+        number of extracted bytes
+
+    """
+    received = 0
+    try:
+        with urllib.request.urlopen(url, timeout=TRANSFER_TIMEOUT) as response:
+            stream = gzip.GzipFile(fileobj=response, mode='rb')
+            with open(part_path, 'wb') as f:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    received += len(chunk)
+    except TRANSFER_ERRORS:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+        raise
+    return received
+
+
+def get_filelists(projects):
+    """ 
+    Requests the file tuples of several projects concurrently.
+
+    Parameters
+    ----------
+    projects : list
+        PRIDE project acession IDs
+
+    Returns
+    -------
+    list
+        Files associated with each project in the order of the projects
+    
+    """
+    with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+        return list(executor.map(get_filelist, projects))
+
+
+def _connections(url, decompress, segments):
+    # decompressed downloads are streamed over a single connection
+    return 1 if decompress and url.endswith('.gz') else segments
+
+
+def download_file(url, dest_folder, chunk_size=DOWNLOAD_CHUNK_SIZE, decompress=False, segments=1):
+    """ 
+    Downloads a file by streaming fixed-size chunks into a partial file,
+    which is renamed to its final name once the transfer is complete.
+    Peak memory is bounded by the chunk size regardless of the file size.
+    A sidecar manifest records the progress of the partial file, so an
+    interrupted download continues where it stopped on the next call.
     
     Parameters
     ----------
@@ -169,6 +444,13 @@ def download_file(url, dest_folder):
         url to a downloadable file.
     dest_folder : str
         path to a destination for the downloaded file.
+    chunk_size : int
+        number of bytes read from the network per write.
+    decompress : bool
+        gunzips a .gz download while it arrives and writes only the extracted file.
+        Decompressed downloads are not resumable.
+    segments : int
+        number of connections fetching separate byte ranges of the file.
 
     Returns
     -------
@@ -177,25 +459,36 @@ def download_file(url, dest_folder):
 
     """
     orig_filename = url.split('/')[-1]
+    decompress = decompress and orig_filename.endswith('.gz')
+
+    if decompress:
+        orig_filename = orig_filename[:-3]
 
     if not os.path.exists(dest_folder):
         os.mkdir(dest_folder)
 
+    dest_path = os.path.join(dest_folder, orig_filename)
+    part_path = dest_path + '.part'
+
     # download file
-    
+    start = time.time()
+
     try:
-        f = urllib.request.urlopen(url)
-    except urllib.error.URLError as err:
+        if decompress:
+            received = _fetch_decompressed(url, part_path, chunk_size)
+        else:
+            received = _fetch_resumable(url, part_path, chunk_size, segments)
+    except TRANSFER_ERRORS as err:
         log.error('Error on request for file: {} error: {}'.format(url, err))
         return None
 
-    data = f.read()
+    os.replace(part_path, dest_path)
 
-    # write file
-    with open(os.path.join(dest_folder, orig_filename), 'wb') as f:
-        f.write(data)
+    elapsed = max(time.time() - start, 1e-6)
+    log.info("Downloaded {} bytes from {} in {:.1f}s ({:.0f} bytes/s)".format(
+        received, url, elapsed, received / elapsed))
 
-    return os.path.join(dest_folder, orig_filename)
+    return dest_path
 
 
 def extract_remove_file(f):
@@ -236,9 +529,10 @@ def extract_remove_file(f):
     return extracted_file
 
 
-def download_projectlist(projects, projectDescriptions, folder, single_file=False):
+def download_projectlist(projects, projectDescriptions, folder, single_file=False, decompress=False, max_transfers=4, max_per_host=4, segments=1, manifest=None, keep_compressed=False):
     """ 
     Downloads a list of file tuples to a destination folder.
+    Transfers run concurrently, both files of a tuple are fetched in parallel.
     
     Parameters
     ----------
@@ -250,6 +544,18 @@ def download_projectlist(projects, projectDescriptions, folder, single_file=Fals
         Destination folder of the downloads
     single_file: bool
         stops execution after donwloading a single file per project
+    decompress: bool
+        decompresses files while downloading instead of extracting them afterwards
+    max_transfers: int
+        maximal number of concurrent transfers
+    max_per_host: int
+        maximal number of concurrent connections to a single host
+    segments: int
+        number of connections used for each file, at most max_per_host
+    manifest: Manifest
+        records the state of every file tuple, extracted tuples are not downloaded again
+    keep_compressed: bool
+        keeps the downloaded .gz files instead of extracting them, the parsers read them directly
     
     Returns
     -------
@@ -262,68 +568,72 @@ def download_projectlist(projects, projectDescriptions, folder, single_file=Fals
             os.mkdir(folder)
 
     downloaded_files = []
+    scheduled = []
+    decompress = decompress and not keep_compressed
+    # files which are already usable after the transfer
+    extracted = decompress or keep_compressed
+
+    # report.json is written once all tuples of a project are done,
+    # projects without it continue their partial downloads
+    if manifest is None:
+        projects = [project for project in projects if not os.path.exists(os.path.join(folder, project, 'report.json'))]
+
+    # the segments of a transfer are connections to the same host
+    segments = max(1, min(segments, max_per_host))
+    connections = partial(_connections, decompress=decompress, segments=segments)
+
+    with DownloadScheduler(max_transfers, max_per_host) as scheduler:
+        for project, files in zip(projects, get_filelists(projects)):
+            if files:
+                log.info(
+                    "Attempting to download {}!".format(project))
+                log.debug(files)
+                for key in files:
+                    file_tuples = files[key][:1] if single_file else files[key]
+                    transfers = []
+                    for mgf_file, mzid_file in file_tuples:
+                        if manifest is not None:
+                            state = manifest.state(project, mgf_file, mzid_file)
+                            if state is not None and state >= EXTRACTED:
+                                continue
+                            if state is None:
+                                manifest.set_state(project, mgf_file, mzid_file, DISCOVERED)
+                        transfers.append((mgf_file, mzid_file,
+                            scheduler.submit(download_file, mgf_file, os.path.join(folder, key), decompress=decompress,
+                                segments=segments, connections=connections(mgf_file)),
+                            scheduler.submit(download_file, mzid_file, os.path.join(folder, key), decompress=decompress,
+                                segments=segments, connections=connections(mzid_file))))
+                    scheduled.append((project, key, transfers))
+
+        # collect in submission order to keep the order of the returned tuples
+        for project, key, transfers in scheduled:
+            for mgf_file, mzid_file, mgf_transfer, mzid_transfer in transfers:
+                mgf = mgf_transfer.result()
+                mzid = mzid_transfer.result()
+
+                if mgf and mzid:
+                    if manifest is not None and not extracted:
+                        manifest.set_state(project, mgf_file, mzid_file, DOWNLOADED, mgf, mzid)
+                    extracted_mgf = mgf if extracted else extract_remove_file(mgf)
+                    log.info("Downloaded: {} to {}".format(
+                        mgf_file, extracted_mgf))
+                    extracted_mzid = mzid if extracted else extract_remove_file(mzid)
+                    log.info("Downloaded: {} to {}".format(
+                        mzid_file, extracted_mzid))
+                    if extracted_mgf and extracted_mzid:
+                        downloaded_files.append((project, extracted_mgf, extracted_mzid))
+                        if manifest is not None:
+                            manifest.set_state(project, mgf_file, mzid_file, EXTRACTED, extracted_mgf, extracted_mzid)
+                else:
+                    log.warning("No generated tuple: Removing files {}".format((mgf, mzid)))
+                    if os.path.exists(str(mzid)):
+                        os.remove(mzid)
+                    if os.path.exists(str(mgf)):
+                        os.remove(mgf)
 
-    for project in projects:
-        if project in os.listdir(folder):
-            continue
-
-        files = get_filelist(project)
-        if files:
-            log.info(
-                "Attempting to download {}!".format(project))
-            log.debug(files)
-            for key in files:
-
-                for mgf_file, mzid_file in files[key]:
-                    mgf = download_file(mgf_file, os.path.join(folder, key))
-                    mzid = download_file(mzid_file, os.path.join(folder, key))
-
-                    if mgf and mzid:
-                        extracted_mgf = extract_remove_file(mgf)
-                        log.info("Downloaded: {} to {}".format(
-                            mgf_file, extracted_mgf))
-                        extracted_mzid = extract_remove_file(mzid)
-                        log.info("Downloaded: {} to {}".format(
-                            mzid_file, extracted_mzid))
-                        if extracted_mgf and extracted_mzid:
-                            downloaded_files.append((project, extracted_mgf, extracted_mzid))
-                    else:
-                        log.warning("No generated tuple: Removing files {}".format((mgf, mzid)))
-                        if os.path.exists(str(mzid)):
-                            os.remove(mzid)
-                        if os.path.exists(str(mgf)):
-                            os.remove(mgf)
-
-                    if single_file:
-                        break
-                    
-                with open(os.path.join(folder, key, 'report.json'), 'w') as jsonFile:
-                        json.dump(fp=jsonFile, obj=projectDescriptions[project])
+            if not os.path.exists(os.path.join(folder, key)):
+                os.mkdir(os.path.join(folder, key))
+            with open(os.path.join(folder, key, 'report.json'), 'w') as jsonFile:
+                    json.dump(fp=jsonFile, obj=projectDescriptions[project])
 
     return downloaded_files
-
-
-def write_archive_file(archivePath, files):
-    """ 
-    Writes archive file containing downloaded and extracted project file tuples! 
-    
-    Parameters
-    ----------
-    archivePath: str
-        Path to the generated archive file.
-    files: list
-        Unordered List of the downloaded and extracted file tuples.
-    
-    Returns
-    -------
-    str
-        Path of generated archive file.
-
-    """
-    with open(archivePath, 'a+') as fp:
-        csvwriter = csv.writer(fp, delimiter=';')
-        for f in files:
-            csvwriter.writerow(list(f))
-    return archivePath
-
-
@@ -0,0 +1,89 @@
+import logging
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger('PrideData')
+
+
+class _HostSlots(object):
+    """
+    Connections to a host, a transfer takes all of its connections at once
+    """
+
+    def __init__(self, size):
+        self.free = size
+        self._condition = threading.Condition()
+
+    def acquire(self, count):
+        with self._condition:
+            self._condition.wait_for(lambda: self.free >= count)
+            self.free -= count
+
+    def release(self, count):
+        with self._condition:
+            self.free += count
+            self._condition.notify_all()
+
+
+class DownloadScheduler(object):
+    """
+    Runs transfers on a bounded thread pool and limits the number of
+    concurrent connections per host. Segmented transfers take one
+    connection per segment.
+    """
+
+    def __init__(self, max_transfers=4, max_per_host=4):
+        self._executor = ThreadPoolExecutor(max_workers=max(1, max_transfers))
+        self._max_per_host = max(1, max_per_host)
+        self._host_slots = dict()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def _host_slot(self, url):
+        host = urllib.parse.urlparse(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = _HostSlots(self._max_per_host)
+            return self._host_slots[host]
+
+    def _run(self, function, url, connections, args, kwargs):
+        slots = self._host_slot(url)
+        slots.acquire(connections)
+        try:
+            return function(url, *args, **kwargs)
+        finally:
+            slots.release(connections)
+
+    def submit(self, function, url, *args, connections=1, **kwargs):
+        """
+        Schedules a transfer.
+
+        Parameters
+        ----------
+        function: callable
+            transfer function called with the url as first argument
+        url: str
+            url of the transferred file, used to determine the host
+        connections: int
+            number of connections the transfer opens to the host, at most max_per_host
+
+        Returns
+        -------
+        concurrent.futures.Future
+            future holding the return value of the transfer function
+
+        """
+        connections = min(max(1, connections), self._max_per_host)
+        return self._executor.submit(self._run, function, url, connections, args, kwargs)
+
+    def shutdown(self):
+        """
+        Waits for all scheduled transfers and releases the worker threads.
+        """
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,221 @@
+import os
+import json
+import ftplib
+import logging
+import http.client
+import threading
+import urllib.error
+import urllib.parse
+import urllib.request
+
+log = logging.getLogger('PrideData')
+
+# errors raised by http and ftp transfers, urllib.error.URLError is an OSError,
+# http.client.IncompleteRead of a body cut off mid-transfer is not
+TRANSFER_ERRORS = ftplib.all_errors + (http.client.HTTPException,)
+
+# seconds a connection may stall before the transfer fails and can be resumed
+TRANSFER_TIMEOUT = 60
+
+
+class RangeError(OSError):
+    """Raised if a server ignores a request for a byte range"""
+
+
+class _FTPStream(object):
+    """Readable data connection of an FTP transfer"""
+
+    def __init__(self, ftp, connection):
+        self._ftp = ftp
+        self._connection = connection
+        self._stream = connection.makefile('rb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def close(self):
+        self._stream.close()
+        self._connection.close()
+        try:
+            self._ftp.close()
+        except ftplib.all_errors:
+            pass
+
+
+def _ftp_connect(parsed_url):
+    ftp = ftplib.FTP(timeout=TRANSFER_TIMEOUT)
+    ftp.connect(parsed_url.hostname, parsed_url.port or 21)
+    ftp.login(parsed_url.username or 'anonymous', parsed_url.password or '')
+    ftp.voidcmd('TYPE I')
+    return ftp
+
+
+def remote_size(url):
+    """
+    Requests the size of a remote file.
+
+    Parameters
+    ----------
+    url: str
+        http(s) or ftp url of the file
+
+    Returns
+    -------
+    int
+        size in bytes or None if the server does not report it
+
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    try:
+        if parsed_url.scheme == 'ftp':
+            ftp = _ftp_connect(parsed_url)
+            try:
+                return ftp.size(urllib.parse.unquote(parsed_url.path))
+            finally:
+                ftp.close()
+
+        request = urllib.request.Request(url, method='HEAD')
+        with urllib.request.urlopen(request, timeout=TRANSFER_TIMEOUT) as response:
+            length = response.headers.get('Content-Length')
+            return int(length) if length else None
+    except TRANSFER_ERRORS + (ValueError,) as err:
+        log.debug('Size request for {} failed: {}'.format(url, err))
+        return None
+
+
+def open_stream(url, offset=0, end=None):
+    """
+    Opens a remote file for reading from a byte offset using HTTP Range or FTP REST.
+
+    Parameters
+    ----------
+    url: str
+        http(s) or ftp url of the file
+    offset: int
+        first byte to read
+    end: int
+        byte position the read stops at, None reads to the end of the file
+
+    Returns
+    -------
+    tuple
+        readable stream and whether the stream starts at the requested offset
+
+    """
+    parsed_url = urllib.parse.urlparse(url)
+
+    if parsed_url.scheme == 'ftp':
+        ftp = _ftp_connect(parsed_url)
+        try:
+            connection = ftp.transfercmd('RETR ' + urllib.parse.unquote(parsed_url.path), rest=offset or None)
+        except ftplib.all_errors:
+            ftp.close()
+            raise
+        return _FTPStream(ftp, connection), True
+
+    request = urllib.request.Request(url)
+    if offset or end is not None:
+        request.add_header('Range', 'bytes={}-{}'.format(offset, '' if end is None else end - 1))
+    response = urllib.request.urlopen(request, timeout=TRANSFER_TIMEOUT)
+    return response, offset == 0 or response.status == 206
+
+
+class PartialManifest(object):
+    """
+    Sidecar manifest of a partially downloaded file. Records the source url,
+    the expected size and the received bytes of every segment of the file.
+    """
+
+    def __init__(self, path, url, size, segments):
+        self.path = path
+        self.url = url
+        self.size = size
+        self.segments = segments
+        self._lock = threading.Lock()
+
+    @classmethod
+    def create(cls, path, url, size, segment_count=1):
+        """
+        Creates a manifest splitting a file of the given size into segments.
+
+        Parameters
+        ----------
+        path: str
+            path of the manifest file
+        url: str
+            source url of the partial file
+        size: int
+            expected size of the file, None if unknown
+        segment_count: int
+            number of segments fetched over separate connections
+
+        Returns
+        -------
+        PartialManifest
+            manifest without received bytes
+
+        """
+        if not size or segment_count < 2:
+            return cls(path, url, size, [[0, size, 0]])
+
+        step = -(-size // segment_count)
+        segments = [[start, min(start + step, size), 0] for start in range(0, size, step)]
+        return cls(path, url, size, segments)
+
+    @classmethod
+    def load(cls, path, url):
+        """
+        Loads a manifest if it exists and belongs to the given url.
+
+        Returns
+        -------
+        PartialManifest
+            loaded manifest or None
+
+        """
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r') as fp:
+                data = json.load(fp)
+        except (OSError, ValueError) as err:
+            log.warning('Ignoring unreadable manifest {}: {}'.format(path, err))
+            return None
+        if data.get('url') != url:
+            return None
+        return cls(path, url, data['size'], data['segments'])
+
+    @property
+    def received(self):
+        return sum(segment[2] for segment in self.segments)
+
+    @property
+    def pending(self):
+        return [segment for segment in self.segments if segment[1] is None or segment[0] + segment[2] < segment[1]]
+
+    def advance(self, segment, count):
+        """
+        Adds received bytes to a segment.
+        """
+        with self._lock:
+            segment[2] += count
+
+    def save(self):
+        """
+        Atomically writes the manifest next to the partial file.
+        """
+        with self._lock:
+            data = {'url': self.url, 'size': self.size, 'received': self.received, 'segments': self.segments}
+            with open(self.path + '.tmp', 'w') as fp:
+                json.dump(fp=fp, obj=data)
+            os.replace(self.path + '.tmp', self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -12,7 +12,12 @@ from writers import json_writer
 from utils import get_memory
 from utils import memory_limit
 
-from accessors.pride_data import get_filelist, get_projectlist, write_archive_file, download_projectlist
+from accessors.pride_data import get_filelist, get_projectlist, download_projectlist, set_metadata_cache
+from accessors.manifest import Manifest
+from accessors.metadata_cache import MetadataCache
+from accessors.discovery import DiscoveryState
+from parsers.parse_cache import ParseCache
+from features.psm_features import LADDER_CACHE_SIZE
 
 log = logging.getLogger('PrideData')
 log.setLevel(logging.DEBUG)
@@ -65,6 +70,23 @@ if __name__ == "__main__":
     parser.add_argument('-SUB', '--submission', default="COMPLETE",
                         type=str, help="SubmissionType for projects.")
     parser.add_argument('-CO', '--cores', default=4, type=int, help="Maximal number of cores!")
+    parser.add_argument('-DS', '--decompress_stream', action='store_true', help="Decompress files while downloading instead of extracting them afterwards!")
+    parser.add_argument('-MT', '--max_transfers', default=4, type=int, help="Maximal number of concurrent downloads!")
+    parser.add_argument('-MH', '--max_per_host', default=4, type=int, help="Maximal number of concurrent connections to a single host, segments included!")
+    parser.add_argument('-SG', '--segments', default=1, type=int, help="Number of connections fetching byte ranges of a single file!")
+    parser.add_argument('-MC', '--metadata_cache', default=None, type=str, help="Folder caching PRIDE web service responses! Defaults to a folder in the data folder.")
+    parser.add_argument('-NC', '--no_cache', action='store_true', help="Disables the cache for PRIDE web service responses!")
+    parser.add_argument('-TTL', '--cache_ttl', default=86400, type=int, help="Seconds a cached PRIDE web service response is used without revalidation, project list pages are always revalidated!")
+    parser.add_argument('-CS', '--cache_size', default=256, type=int, help="Maximal size of the PRIDE web service cache in MB!")
+    parser.add_argument('-OF', '--offline', action='store_true', help="Only uses cached PRIDE web service responses!")
+    parser.add_argument('-KC', '--keep_compressed', action='store_true', help="Keeps downloaded files gzip compressed and parses them directly!")
+    parser.add_argument('-INC', '--incremental', action='store_true', help="Stops searching project pages once previously processed projects are listed!")
+    parser.add_argument('-SRC', '--spectra_source', default='index', choices=['stream', 'index', 'store'], help="Reads spectra by streaming the MGF, through its offset index or from a columnar spectrum store converted once!")
+    parser.add_argument('-PMZ', '--parallel_mzid_size', default=0, type=int, help="Parses mzids of at least this size in MB in parallel chunks, 0 disables it!")
+    parser.add_argument('-PC', '--parse_cache', default=None, type=str, help="Folder caching parsed mzids and spectra, repeated jobs skip parsing! Disabled if not given.")
+    parser.add_argument('-PCS', '--parse_cache_size', default=4096, type=int, help="Maximal size of the parse cache in MB!")
+    parser.add_argument('-LCS', '--ladder_cache_size', default=LADDER_CACHE_SIZE, type=int, help="Number of fragment ladders cached by every process!")
+    parser.add_argument('-TR', '--top_rank_only', action='store_true', help="Only writes the rank 1 PSMs of each spectrum to the csv!")
     args = parser.parse_args()
         
     if args.ini:
@@ -76,31 +98,45 @@ if __name__ == "__main__":
     print(args)
 
     memory_limit(args.memory)
-    projects, projectDescriptions = get_projectlist(args)
+
+    if not args.no_cache:
+        set_metadata_cache(MetadataCache(args.metadata_cache or os.path.join(args.folder, '.metadata_cache'),
+            args.cache_ttl, args.cache_size * 1024 * 1024, args.offline))
+
+    discovery = DiscoveryState(os.path.join(args.folder, 'discovery.json')) if args.incremental else None
+    projects, projectDescriptions = get_projectlist(args, discovery)
     log.info("Found {} matching projects!".format(len(projects)))
     log.debug(projects)
 
-    archivePath = os.path.join(args.folder, 'archive')
+    archivePath = os.path.join(args.folder, 'archive.db')
+    jsonPath = os.path.join(args.folder, 'psms.json')
 
-    if os.path.exists(archivePath):
-        with open(archivePath) as fp:
-            for line in fp:
-                for project in projects:
-                    if project in line:
-                        projects.remove(project)
+    manifest = Manifest(archivePath)
+    if manifest.import_archive(os.path.join(args.folder, 'archive')):
+        os.rename(os.path.join(args.folder, 'archive'), os.path.join(args.folder, 'archive.imported'))
 
     if args.single_file:
         log.info('Only downloading single file tuples for each available project!')
 
     if projects:
-        downloaded_files = download_projectlist(projects, projectDescriptions, args.folder, args.single_file)
+        downloaded_files = download_projectlist(projects, projectDescriptions, args.folder, args.single_file,
+            decompress=args.decompress_stream, max_transfers=args.max_transfers, max_per_host=args.max_per_host,
+            segments=args.segments, manifest=manifest, keep_compressed=args.keep_compressed)
+        log.info("Downloaded {} file tuples!".format(len(downloaded_files)))
+
+    # projects with failed transfers are listed again by the next run
+    incomplete = manifest.incomplete_projects(projects)
+    manifest.close()
+
+    if discovery:
+        discovery.commit(incomplete)
 
-        jsonPath = os.path.join(args.folder, 'psms.json')
-        if downloaded_files:
-            write_archive_file(archivePath, downloaded_files)
+    parse_cache = ParseCache(args.parse_cache, args.parse_cache_size * 1024 * 1024) if args.parse_cache else None
 
     if args.csv:
-        csv_writer.writeCSVPSMSfromArchive(archivePath, args.cores, args.features, args.csv_location[0])
+        csv_writer.writeCSVPSMSfromArchive(archivePath, args.cores, args.features, args.csv_location[0], spectra_source=args.spectra_source,
+            parallel_mzid_size=args.parallel_mzid_size * 1024 * 1024, parse_cache=parse_cache, ladder_cache_size=args.ladder_cache_size,
+            top_rank_only=args.top_rank_only)
 
     if args.json:
-        json_writer.writeJSONPSMSfromArchive(archivePath, jsonPath)
\ No newline at end of file
+        json_writer.writeJSONPSMSfromArchive(archivePath, jsonPath, parse_cache=parse_cache)
\ No newline at end of file
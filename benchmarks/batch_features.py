@@ -0,0 +1,113 @@
+import os
+import sys
+import math
+import time
+import random
+import argparse
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsers.spectrum import Spectrum
+from parsers.psm_table import PSMTable
+from features.psm_features import FeatureList, ladder_cache
+from features.batch_features import calculate_batch_features
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def synthetic_psms(count, peaks, peptides=None):
+    """
+    Generates PSMs with random peptides and spectra, a third of the peaks are fragments of the peptide
+
+    Parameters
+    ----------
+    count: int
+        number of psms
+    peaks: int
+        number of peaks per spectrum
+    peptides: int
+        number of distinct peptides, every psm has its own peptide by default
+
+    Returns
+    -------
+    tuple
+        PSMTable and a Spectrum per psm
+
+    """
+    rng = random.Random(0)
+    table = PSMTable()
+    spectra = []
+    pool = []
+    for index in range(count):
+        if peptides is None or len(pool) < peptides:
+            sequence = ''.join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(7, 25)))
+            modifications = [(15.994915, rng.randint(1, len(sequence)))] if rng.random() < 0.3 else []
+            pool.append((sequence, modifications))
+        else:
+            sequence, modifications = rng.choice(pool)
+        pepmass = rng.uniform(400, 1200)
+        table.append('index={}'.format(index), '1', str(pepmass), str(pepmass + rng.uniform(-0.01, 0.01)), 'false',
+                     sequence, modifications, [('Mascot:score', str(rng.uniform(0, 80)))])
+
+        fragments = numpy.cumsum([rng.uniform(57, 186) for _ in range(peaks // 3)])
+        mz = numpy.concatenate([fragments + rng.uniform(-0.02, 0.02), [rng.uniform(100, 2000) for _ in range(peaks - len(fragments))]])
+        intensity = numpy.array([rng.uniform(1, 1e5) for _ in range(len(mz))])
+        spectra.append(Spectrum('spectrum {}'.format(index), pepmass, 2, mz, intensity))
+    return table, spectra
+
+
+def per_psm_features(psms, spectra):
+    rows = []
+    for psm, spectrum in zip(psms, spectra):
+        features = FeatureList(psm, spectrum, 0.05, 0.05)
+        rows.append(features.dictionary if features.calculate_features() else None)
+    return rows
+
+
+def batch_features(psms, spectra):
+    table = calculate_batch_features(psms, spectra, 0.05, 0.05)
+    return [table.dictionary(row) for row in range(len(table))]
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the batch feature engine against FeatureList!")
+    parser.add_argument('-N', '--psms', type=int, default=20000, help="Number of synthetic PSMs!")
+    parser.add_argument('-P', '--peaks', type=int, default=300, help="Number of peaks per spectrum!")
+    parser.add_argument('-U', '--peptides', type=int, default=None, help="Number of distinct peptides, one per PSM by default!")
+    args = parser.parse_args()
+
+    table, spectra = synthetic_psms(args.psms, args.peaks, args.peptides)
+    psms = list(table)
+
+    # both are compiled before timing
+    per_psm_features(psms[:1], spectra[:1])
+    batch_features(psms[:1], spectra[:1])
+
+    reference, reference_time = timed(per_psm_features, psms, spectra)
+    print('FeatureList per psm:     {:.2f}s'.format(reference_time))
+
+    ladder_cache.resize(0)
+    ladder_cache.resize(args.psms)
+    ladder_cache.hits = ladder_cache.misses = 0
+    batch, batch_time = timed(batch_features, psms, spectra)
+    print('batch feature engine:    {:.2f}s ({:.1f}x)'.format(batch_time, reference_time / batch_time))
+    print('ladder cache hit rate:   {:.1%}'.format(ladder_cache.hit_rate()))
+
+    for expected, row in zip(reference, batch):
+        assert (expected is None) == (row is None)
+        if expected is not None:
+            assert expected.keys() == row.keys()
+            assert all(expected[key] == row[key] or (isinstance(row[key], float) and math.isnan(row[key]))
+                       for key in expected)
+    print('features identical for {} psms'.format(len(psms)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+import os
+import re
+import sys
+import time
+import random
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from parsers.mgf_file import parse_mgf, parse_peaks, iter_spectrum_blocks, parse_peaks_linewise
+
+
+def write_mgf(path, spectra, peaks, separator='\t'):
+    """
+    Writes a synthetic MGF
+
+    Parameters
+    ----------
+    path: str
+        path of the generated mgf
+    spectra: int
+        number of spectra
+    peaks: int
+        number of peaks per spectrum
+    separator: str
+        separator of the peak columns
+
+    """
+    rng = random.Random(0)
+    with open(path, 'w') as fp:
+        for index in range(spectra):
+            fp.write('BEGIN IONS\nTITLE=spectrum {0}\nPEPMASS={1:.5f}\nCHARGE={2}+\n'.format(
+                index, rng.uniform(300, 1500), rng.randint(1, 4)))
+            for _ in range(peaks):
+                fp.write('{0:.4f}{1}{2:.2f}\n'.format(rng.uniform(100, 2000), separator, rng.uniform(1, 1e5)))
+            fp.write('END IONS\n\n')
+
+
+def reference_parse_mgf(input_file):
+    """
+    Line based parser the vectorized parser replaced, kept as reference
+    """
+    with open(input_file, 'r') as mgf_file:
+        mgf_list = mgf_file.read().split('\n')
+
+    index = 0
+    tokens = dict()
+    line = mgf_list[index]
+    while not 'END IONS' in line:
+        if '=' in line:
+            tokens[line.split('=')[0]] = index
+        if re.match(r'\d+\.\d+\t\d+\.\d+', line):
+            tokens['LISTS'] = index
+            break
+        index += 1
+        line = mgf_list[index]
+
+    entries = dict()
+    index = 0
+    spectrum_mgf_index = 0
+    while index < len(mgf_list):
+        line = mgf_list[index]
+        if 'BEGIN IONS' in line:
+            attributes = dict()
+            attributes['title'] = re.sub(r'TITLE=', '', mgf_list[index + tokens['TITLE']])
+            attributes['pepmass'] = float(re.sub(r'PEPMASS=', '', mgf_list[index + tokens['PEPMASS']]))
+            line = mgf_list[index + tokens['CHARGE']]
+            attributes['charge'] = int(re.match(r'CHARGE=(\d)\+', line)[1] if re.match(r'CHARGE=(\d)\+', line) else 0)
+            spectrum_index = index + tokens['LISTS']
+            line = mgf_list[spectrum_index]
+            mz_lst = []
+            intensity_lst = []
+            while not 'END IONS' in line:
+                line_split = line.split('\t')
+                mz_lst.append(float(line_split[0].strip()))
+                intensity_lst.append(float(line_split[1].strip()))
+                spectrum_index += 1
+                line = mgf_list[spectrum_index]
+            attributes['mz_list'] = mz_lst
+            attributes['intensity_list'] = intensity_lst
+            entries['index=' + str(spectrum_mgf_index)] = attributes
+            spectrum_mgf_index += 1
+        index += 1
+    return entries
+
+
+def linewise_peaks(input_file):
+    """
+    Splits spectra like the vectorized parser but converts peaks line by line
+    """
+    peaks = 0
+    with open(input_file, 'rb') as mgf_file:
+        for block in iter_spectrum_blocks(mgf_file):
+            mz_lst, _ = parse_peaks_linewise(block[block.rfind(b'=') + 1:].split(b'\n', 1)[1])
+            peaks += len(mz_lst)
+    return peaks
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the vectorized MGF parser against the line based parser!")
+    parser.add_argument('-S', '--spectra', type=int, default=20000, help="Number of spectra in the synthetic MGF!")
+    parser.add_argument('-P', '--peaks', type=int, default=300, help="Number of peaks per spectrum!")
+    parser.add_argument('-MGF', '--mgf', default=None, help="Benchmarks an existing tab separated MGF instead!")
+    args = parser.parse_args()
+
+    path = args.mgf
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'benchmark.mgf')
+        write_mgf(path, args.spectra, args.peaks)
+
+    print('MGF: {} ({:.1f} MB)'.format(path, os.path.getsize(path) / 1024 / 1024))
+
+    reference, reference_time = timed(reference_parse_mgf, path)
+    print('reference line parser:   {:.2f}s'.format(reference_time))
+
+    _, linewise_time = timed(linewise_peaks, path)
+    print('line-by-line peaks:      {:.2f}s'.format(linewise_time))
+
+    _, compile_time = timed(parse_peaks, b'100.0\t1.0\n')
+    print('tokenizer compilation:   {:.2f}s'.format(compile_time))
+
+    (entries, _), vectorized_time = timed(parse_mgf, path)
+    print('vectorized parser:       {:.2f}s ({:.1f}x)'.format(vectorized_time, reference_time / vectorized_time))
+
+    for key, attributes in reference.items():
+        spectrum = entries[key]
+        expected = sorted(zip(attributes['mz_list'], attributes['intensity_list']), key=lambda x: x[0])
+        assert spectrum.title == attributes['title'] and spectrum.pepmass == attributes['pepmass']
+        assert spectrum.charge == attributes['charge'] and spectrum.sumI == sum(attributes['intensity_list'])
+        assert list(zip(spectrum.mz.tolist(), spectrum.intensity.tolist())) == expected
+    print('results identical for {} spectra'.format(len(reference)))
+
+
+if __name__ == '__main__':
+    main()
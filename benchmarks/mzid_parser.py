@@ -0,0 +1,248 @@
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import xml.sax
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils import open_file
+from parsers.mzid_handler import MZIdentMLHandler, make_result
+
+AMINO_ACIDS = 'ACDEFGHIKLMNPQRSTVWY'
+
+
+def write_mzid(path, spectra, ranks=3):
+    """
+    Writes a synthetic Mascot mzid
+
+    Parameters
+    ----------
+    path: str
+        path of the generated mzid
+    spectra: int
+        number of spectrum identification results
+    ranks: int
+        number of identification items per result
+
+    """
+    rng = random.Random(0)
+    peptides = spectra * ranks
+    with open(path, 'w') as fp:
+        fp.write('<?xml version="1.0" encoding="UTF-8"?>\n<MzIdentML xmlns="http://psidev.info/psi/pi/mzIdentML/1.1" id="benchmark">\n')
+        fp.write('<AnalysisSoftwareList><AnalysisSoftware id="AS_mascot_server" name="Mascot Server" version="2.5.1"/></AnalysisSoftwareList>\n')
+        fp.write('<SequenceCollection>\n')
+        for index in range(peptides):
+            sequence = ''.join(rng.choice(AMINO_ACIDS) for _ in range(rng.randint(7, 25)))
+            fp.write('<Peptide id="peptide_{0}"><PeptideSequence>{1}</PeptideSequence>'.format(index, sequence))
+            if index % 3 == 0:
+                fp.write('<Modification location="{0}" monoisotopicMassDelta="15.994915"><cvParam accession="UNIMOD:35" '
+                         'name="Oxidation" cvRef="UNIMOD"/></Modification>'.format(1 + index % len(sequence)))
+            fp.write('</Peptide>\n')
+        for index in range(peptides):
+            fp.write('<PeptideEvidence id="PE_{0}" peptide_ref="peptide_{0}" dBSequence_ref="DBSeq_1" start="1" end="9" '
+                     'isDecoy="{1}"/>\n'.format(index, 'true' if index % 7 == 0 else 'false'))
+        fp.write('</SequenceCollection>\n<AnalysisProtocolCollection><SpectrumIdentificationProtocol id="SIP_1"><FragmentTolerance>\n')
+        fp.write('<cvParam accession="MS:1001412" name="search tolerance plus value" value="0.02" cvRef="PSI-MS" unitName="dalton"/>\n')
+        fp.write('<cvParam accession="MS:1001413" name="search tolerance minus value" value="0.02" cvRef="PSI-MS" unitName="dalton"/>\n')
+        fp.write('</FragmentTolerance></SpectrumIdentificationProtocol></AnalysisProtocolCollection>\n')
+        fp.write('<DataCollection><AnalysisData><SpectrumIdentificationList id="SIL_1">\n')
+        peptide = 0
+        for index in range(spectra):
+            fp.write('<SpectrumIdentificationResult id="SIR_{0}" spectrumID="index={0}" spectraData_ref="SD_1">\n'.format(index))
+            precursor = rng.uniform(400, 1500)
+            for rank in range(1, ranks + 1):
+                fp.write('<SpectrumIdentificationItem id="SII_{0}_{1}" calculatedMassToCharge="{2:.6f}" chargeState="2" '
+                         'experimentalMassToCharge="{3:.6f}" peptide_ref="peptide_{4}" rank="{1}" passThreshold="true">'.format(
+                             index, rank, precursor + rng.uniform(-0.01, 0.01), precursor, peptide))
+                fp.write('<PeptideEvidenceRef peptideEvidence_ref="PE_{0}"/>'.format(peptide))
+                fp.write('<cvParam accession="MS:1001171" name="Mascot:score" value="{0:.2f}" cvRef="PSI-MS"/>'.format(rng.uniform(5, 80)))
+                fp.write('<cvParam accession="MS:1001371" name="Mascot:identity threshold" value="{0}" cvRef="PSI-MS"/>'.format(rng.randint(20, 40)))
+                fp.write('<cvParam accession="MS:1001370" name="Mascot:homology threshold" value="{0}" cvRef="PSI-MS"/>'.format(rng.randint(10, 30)))
+                fp.write('<cvParam accession="MS:1001172" name="Mascot:expectation value" value="{0:.6f}" cvRef="PSI-MS"/>'.format(rng.random()))
+                fp.write('<userParam name="Mascot:num matched peaks" value="{0}"/>'.format(rng.randint(3, 40)))
+                fp.write('</SpectrumIdentificationItem>\n')
+                peptide += 1
+            fp.write('<cvParam accession="MS:1000796" name="spectrum title" value="spectrum {0}" cvRef="PSI-MS"/>\n'.format(index))
+            fp.write('</SpectrumIdentificationResult>\n')
+        fp.write('</SpectrumIdentificationList></AnalysisData></DataCollection>\n</MzIdentML>\n')
+
+
+class ReferenceMZIdentMLHandler(xml.sax.handler.ContentHandler):
+    """
+    SAX handler the expat parser replaced, kept as reference
+    """
+
+    def __init__(self):
+        self._result_params = dict()
+
+        self._result_spec_ident = dict()
+        self._result_pep = list()
+        self._result_pep_evid = dict()
+        self._result_pep_seq = dict()
+        self._result_mod = dict()
+        self._result_ident_params = dict()
+
+        self._peptide_ref = 0
+        self._sequence = 1
+
+        self._open_tags = list()
+
+        self._charBuffer = []
+
+        self._current_pep = str()
+        self._current_spec_ident = str()
+        self._current_spec_id = str()
+
+    def parse(self, f):
+        """ 
+        SAX parser for mzid extracting psm information. 
+        
+        Parameters
+        ----------
+        f: path
+            path to a plain or gzip compressed MZID or a readable file
+        
+        Returns
+        -------
+        dict
+            psm result
+        
+        """
+        
+        if isinstance(f, str):
+            with open_file(f, 'rb') as fp:
+                xml.sax.parse(fp, self)
+        else:
+            xml.sax.parse(f, self)
+
+        results = dict()
+
+        for peptide in self._result_pep:
+            result =  make_result(
+                self._result_spec_ident[peptide] if peptide in self._result_spec_ident else None, 
+                self._result_pep_evid[peptide] if peptide in self._result_pep_evid else None, 
+                self._result_pep_seq[peptide] if peptide in self._result_pep_seq else None, 
+                self._result_mod[peptide] if peptide in self._result_mod else None,
+                self._result_ident_params[peptide] if peptide in self._result_ident_params else None)
+
+            if result:
+                results[self._result_spec_ident[peptide][0]] = result
+        
+        return results, self._result_params
+
+    def _getCharacterData(self):
+        data = ''.join(self._charBuffer).strip()
+        self._charBuffer = []
+        return data.strip()  # remove strip() if whitespace is important
+
+    def startElement(self, name, attrs):
+        self._open_tags.append(name)
+
+        if name == 'AnalysisSoftware':
+            if 'name' in attrs.getNames():
+                self._result_params['AnalysisSoftware'] = attrs.getValue('name')
+            else:
+                self._result_params['AnalysisSoftware'] = attrs.getValue('id')
+
+        elif name == 'cvParam':
+            if 'Modification' in self._open_tags:
+                if self._current_pep in self._result_mod:
+                    self._result_mod[self._current_pep][-1] + \
+                        (attrs.getValue('name'),)
+
+            elif 'FragmentTolerance' in self._open_tags:
+                if "search tolerance plus value" in attrs.getValue("name") and "dalton" in attrs.getValue("unitName"):
+                    self._result_params['search tolerance plus value'] = float(
+                        attrs.getValue('value'))
+                elif "search tolerance minus value" in attrs.getValue("name") and "dalton" in attrs.getValue("unitName"):
+                    self._result_params['search tolerance minus value'] = float(
+                        attrs.getValue('value'))
+
+            elif "SpectrumIdentificationItem" in self._open_tags:
+                if 'value' in attrs.getNames():
+                    if self._current_spec_ident in self._result_ident_params:
+                        self._result_ident_params[self._current_spec_ident].append((attrs.getValue('name'), attrs.getValue('value')))
+                    else:
+                        self._result_ident_params[self._current_spec_ident] = list()
+                        self._result_ident_params[self._current_spec_ident].append((attrs.getValue('name'), attrs.getValue('value')))
+
+        elif name == 'Modification':
+            if self._current_pep in self._result_mod:
+                self._result_mod[self._current_pep].append(
+                    (attrs.getValue('monoisotopicMassDelta'), attrs.getValue('location')))
+            else:
+                self._result_mod[self._current_pep] = list()
+                self._result_mod[self._current_pep].append(
+                    (attrs.getValue('monoisotopicMassDelta'), attrs.getValue('location')))
+
+        elif name == 'userParam':
+            if 'fragment_ion_tolerance' in attrs.getValue('name') and "dalton" in attrs.getValue("unitName"):
+                self._result_params['search tolerance plus value'] = float(
+                        attrs.getValue('value'))
+                self._result_params['search tolerance minus value'] = float(
+                        attrs.getValue('value'))
+
+        elif name == 'SpectrumIdentificationItem':
+            self._current_spec_ident = attrs.getValue('peptide_ref')
+            self._result_spec_ident[attrs.getValue('peptide_ref')] = (self._current_spec_id, attrs.getValue(
+                'rank'), attrs.getValue('experimentalMassToCharge'),  attrs.getValue('calculatedMassToCharge'))
+
+        elif name == 'SpectrumIdentificationResult':
+            self._current_spec_id = attrs.getValue('spectrumID').split()[0]
+
+        elif name == 'Peptide':
+            self._current_pep = attrs.getValue('id')
+            self._result_pep.append(self._current_pep)
+
+        elif name == 'PeptideEvidence':
+            if 'isDecoy' in attrs.getNames():
+                self._result_pep_evid[attrs.getValue('peptide_ref')] = attrs.getValue('isDecoy')
+
+    def endElement(self, name):
+        if name == 'PeptideSequence':
+            self._result_pep_seq[self._current_pep] = self._getCharacterData()
+
+        self._open_tags.remove(name)
+
+    def characters(self, data):
+        if 'PeptideSequence' in self._open_tags:
+            self._charBuffer.append(data)
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the expat mzid parser against the SAX handler!")
+    parser.add_argument('-S', '--spectra', type=int, default=100000, help="Number of spectrum identification results in the synthetic mzid!")
+    parser.add_argument('-R', '--ranks', type=int, default=3, help="Number of identification items per result!")
+    parser.add_argument('-MZID', '--mzid', default=None, help="Benchmarks an existing mzid instead!")
+    args = parser.parse_args()
+
+    path = args.mzid
+    if path is None:
+        path = os.path.join(tempfile.mkdtemp(), 'benchmark.mzid')
+        write_mzid(path, args.spectra, args.ranks)
+
+    print('MZID: {} ({:.1f} MB)'.format(path, os.path.getsize(path) / 1024 / 1024))
+
+    (reference, reference_params), reference_time = timed(ReferenceMZIdentMLHandler().parse, path)
+    print('SAX handler:    {:.2f}s'.format(reference_time))
+
+    (results, params), expat_time = timed(MZIdentMLHandler().parse, path)
+    print('expat parser:   {:.2f}s ({:.1f}x)'.format(expat_time, reference_time / expat_time))
+
+    assert params == reference_params and list(results) == list(reference)
+    for key, result in reference.items():
+        assert results[key].__dict__ == result.__dict__
+    print('results identical for {} PSMs'.format(len(reference)))
+
+
+if __name__ == '__main__':
+    main()
@@ -15,7 +15,12 @@ from utils import memory_limit
 
 import time
 import datetime
-from accessors.pride_data import get_filelist, get_projectlist, write_archive_file, download_projectlist
+from accessors.pride_data import get_filelist, get_projectlist, download_projectlist, set_metadata_cache
+from accessors.manifest import Manifest
+from accessors.metadata_cache import MetadataCache
+from accessors.discovery import DiscoveryState
+from parsers.parse_cache import ParseCache
+from features.psm_features import LADDER_CACHE_SIZE
 
 from hdfs import InsecureClient
 from cassandra.cluster import Cluster
@@ -56,40 +61,61 @@ if __name__ == "__main__":
                 csvs = None
 
                 memory_limit(args.memory)
-                projects, projectDescriptions = get_projectlist(args)
-                log.info("Found {} matching projects!".format(len(projects)))
-                log.debug(projects)
 
-                archivePath = os.path.join("data_pride", 'archive')
+                if not getattr(args, 'no_cache', False):
+                    set_metadata_cache(MetadataCache(getattr(args, 'metadata_cache', None) or os.path.join(args.folder, '.metadata_cache'),
+                        getattr(args, 'cache_ttl', 86400), getattr(args, 'cache_size', 256) * 1024 * 1024, getattr(args, 'offline', False)))
+                else:
+                    set_metadata_cache(None)
 
-                if os.path.exists(archivePath):
-                    log.info('Archive exists! Deleting archived data!')
-                    os.remove(archivePath)
+                discovery = DiscoveryState(os.path.join(args.folder, 'discovery.json')) if getattr(args, 'incremental', False) else None
+                projects, projectDescriptions = get_projectlist(args, discovery)
+                log.info("Found {} matching projects!".format(len(projects)))
+                log.debug(projects)
 
                 if not os.path.exists(args.folder):
                     log.info('Folder does not exists! Creating {}!'.format(args.folder))
                     os.makedirs(args.folder)
 
+                # the manifest persists across jobs, finished tuples are not downloaded again
+                archivePath = os.path.join(args.folder, 'archive.db')
+                manifest = Manifest(archivePath)
+
                 if args.single_file:
                     log.info('Only downloading single file tuples for each available project!')
 
                 if projects:
                     log.info("Downloading files {}".format(projects))
-                    downloaded_files = download_projectlist(projects, projectDescriptions, args.folder, args.single_file)
+                    downloaded_files = download_projectlist(projects, projectDescriptions, args.folder, args.single_file,
+                        decompress=getattr(args, 'decompress_stream', False), max_transfers=getattr(args, 'max_transfers', 4), max_per_host=getattr(args, 'max_per_host', 4),
+                        segments=getattr(args, 'segments', 1), manifest=manifest, keep_compressed=getattr(args, 'keep_compressed', False))
+                    log.info("Downloaded {} file tuples!".format(len(downloaded_files)))
 
                     jsonPath = os.path.join(args.folder, 'psms.json')
-                    
-                    if downloaded_files:
-                        write_archive_file(archivePath, downloaded_files)
 
+                    # parsed files are shared by jobs with other feature lists
+                    parse_cache = ParseCache(args.parse_cache, getattr(args, 'parse_cache_size', 4096) * 1024 * 1024) if getattr(args, 'parse_cache', None) else None
+                    
+                    if manifest.files(projects):
                         if args.csv:
-                            csvs = csv_writer.writeCSVPSMSfromArchive(archivePath, args.cores, args.features)
+                            csvs = csv_writer.writeCSVPSMSfromArchive(archivePath, args.cores, args.features, projects=projects,
+                                spectra_source=getattr(args, 'spectra_source', 'index'),
+                                parallel_mzid_size=getattr(args, 'parallel_mzid_size', 0) * 1024 * 1024, parse_cache=parse_cache,
+                                ladder_cache_size=getattr(args, 'ladder_cache_size', LADDER_CACHE_SIZE),
+                                top_rank_only=getattr(args, 'top_rank_only', False))
 
                         if args.json:
-                            json_writer.writeJSONPSMSfromArchive(archivePath, jsonPath)
+                            json_writer.writeJSONPSMSfromArchive(archivePath, jsonPath, projects=projects, parse_cache=parse_cache)
                     
                     else:
                         log.warning("No files downloaded!")
+
+                # projects with failed transfers are listed again by the next job
+                incomplete = manifest.incomplete_projects(projects)
+                manifest.close()
+
+                if discovery:
+                    discovery.commit(incomplete)
             
             except Exception as err:
                 log.error("Exception {}".format(err)) 
@@ -0,0 +1,294 @@
+import sys
+import math
+import logging
+import numpy
+from numba import jit
+
+from features.psm_features import match_fragments, modification_vector, ladder_cache
+from features.psm_labeler import class_label
+
+log = logging.getLogger("PrideData")
+
+# psms calculated at once by the csv writer
+FEATURE_BATCH_SIZE = 10000
+
+# keys of FeatureList.dictionary in their order
+FEATURES = ("Hyperscore", "Domain_Id", "Charge", "sumI", "norm_high_peak_intensity", "Num_of_Modifications",
+            "Pep_Len", "Num_Pl", "mh(group)", "mh(domain)", "uniqueDM", "uniqueDMppm", "Sum_match_intensities",
+            "Log_sum_match_intensity", "b+_ratio", "b++_ratio", "y+_ratio", "y++_ratio", "b+_count", "b++_count",
+            "y+_count", "y++_count", "b+_long_count", "b++_long_count", "y+_long_count", "y++_long_count",
+            "median_matched_frag_ion_errors", "mean_matched_frag_ion_errors", "iqr_matched_frag_ion_errors",
+            "Class_Label", "ClassLabel_Decision")
+
+# the builtin sum adds floats with compensation since python 3.12
+_COMPENSATED_SUM = sys.version_info >= (3, 12)
+
+
+@jit(nopython=True, cache=True)
+def _builtin_sum(values, count, compensated):
+    # sum of python floats like the builtin sum adds them
+    if count == 0:
+        return 0.0
+    total = values[0]
+    compensation = 0.0
+    for i in range(1, count):
+        x = values[i]
+        if compensated:
+            t = total + x
+            if abs(total) >= abs(x):
+                compensation += (total - t) + x
+            else:
+                compensation += (x - t) + total
+            total = t
+        else:
+            total += x
+    if compensation != 0.0 and math.isfinite(compensation):
+        total += compensation
+    return total
+
+
+@jit(nopython=True, cache=True)
+def _batch_kernel(ladders, ladder_offsets, mz, intensity, peak_offsets, highest_intensities, intensity_sums,
+                  spectrum_rows, upperthreshold, lowerthreshold, compensated, counts, longest, statistics, error_offsets):
+    # the sorted matching errors of psm p are returned at error_offsets[p]:error_offsets[p + 1]
+    max_peaks = 0
+    for s in range(len(peak_offsets) - 1):
+        max_peaks = max(max_peaks, peak_offsets[s + 1] - peak_offsets[s])
+
+    max_length = 1
+    for p in range(len(spectrum_rows)):
+        max_length = max(max_length, (ladder_offsets[p + 1] - ladder_offsets[p]) // 4)
+
+    matched_peaks = numpy.empty(max_peaks)
+    matched_intensities = numpy.empty(max_peaks)
+    errors = numpy.empty(4 * (max_peaks + max_length))
+    error_values = numpy.empty(max(16, 4 * len(spectrum_rows)))
+
+    for p in range(len(spectrum_rows)):
+        error_offsets[p + 1] = error_offsets[p]
+        s = spectrum_rows[p]
+        begin, end = peak_offsets[s], peak_offsets[s + 1]
+        length = (ladder_offsets[p + 1] - ladder_offsets[p]) // 4
+        if length == 0:
+            # psms without ladders are not valid
+            statistics[p, :] = numpy.nan
+            continue
+
+        error_count = 0
+        sum_matched_intensities = 0.0
+        # the ladders of a psm are b+, b++, y+ and y++ like the columns of counts and longest
+        for k in range(4):
+            first = ladder_offsets[p] + k * length
+            matches, longest_series, error_count = match_fragments(
+                ladders[first:first + length], length, mz, intensity, begin, end, upperthreshold, lowerthreshold,
+                matched_peaks, matched_intensities, errors, error_count)
+            counts[p, k] = matches
+            longest[p, k] = longest_series
+            sum_matched_intensities += _builtin_sum(matched_intensities, matches, compensated)
+
+        statistics[p, 0] = highest_intensities[s]
+        statistics[p, 1] = intensity_sums[s]
+        statistics[p, 2] = sum_matched_intensities
+        if error_count == 0:
+            statistics[p, 3:] = numpy.nan
+            continue
+
+        matching_errors = numpy.sort(errors[:error_count])
+        total = 0.0
+        for i in range(error_count):
+            total += matching_errors[i]
+        statistics[p, 3] = total / error_count
+        if error_count % 2 == 1:
+            statistics[p, 4] = matching_errors[int(error_count / 2)]
+        else:
+            statistics[p, 4] = (matching_errors[int(error_count / 2) - 1] + matching_errors[int(error_count / 2)]) / 2
+
+        stored = error_offsets[p]
+        if stored + error_count > len(error_values):
+            grown = numpy.empty(max(2 * len(error_values), stored + error_count))
+            grown[:stored] = error_values[:stored]
+            error_values = grown
+        error_values[stored:stored + error_count] = matching_errors
+        error_offsets[p + 1] = stored + error_count
+
+    return error_values[:error_offsets[len(spectrum_rows)]]
+
+
+def _interquartile_ranges(error_values, error_offsets):
+    # numpy.percentile like FeatureList, on psms with the same number of errors at once
+    error_counts = numpy.diff(error_offsets)
+    ranges = numpy.full(len(error_counts), numpy.nan)
+    for count in numpy.unique(error_counts[error_counts > 0]):
+        rows = numpy.flatnonzero(error_counts == count)
+        errors = error_values[error_offsets[rows][:, None] + numpy.arange(count)]
+        ranges[rows] = numpy.subtract(*numpy.percentile(errors, [75, 25], axis=1))
+    return ranges
+
+
+class FeatureTable(object):
+    """
+    Features of a batch of psms as columns. Rows with at least one matched
+    fragment are valid, dictionary returns the values FeatureList.dictionary
+    holds for a valid row.
+    """
+
+    def __init__(self, psms, spectra, columns, valid):
+        self.psms = psms
+        self.spectra = spectra
+        self.columns = columns
+        self.valid = valid
+
+    def __len__(self):
+        return len(self.valid)
+
+    def dictionary(self, row):
+        """
+        Returns the features of a row.
+
+        Returns
+        -------
+        dict
+            features by name or None if the row is not valid
+
+        """
+        if not self.valid[row]:
+            return None
+        return dict(zip(FEATURES, self._values(row)))
+
+    def rows(self, features=FEATURES):
+        """
+        Yields the features of every row.
+
+        Parameters
+        ----------
+        features: list
+            names of the features
+
+        Yields
+        ------
+        dict
+            features by name or None if the row is not valid
+
+        """
+        for row in range(len(self.valid)):
+            dictionary = self.dictionary(row)
+            yield None if dictionary is None else {feature: dictionary[feature] for feature in features}
+
+    def _values(self, row):
+        psm = self.psms[row]
+        spectrum = self.spectra[row]
+        columns = self.columns
+
+        mascot_score = psm.score('mascot_score')
+        if math.isnan(mascot_score):
+            mascot_score = 0
+
+        counts = [int(count) for count in columns['counts'][row]]
+        matches = sum(counts)
+        ratios = [count / matches for count in counts] if matches > 0 else [0, 0, 0, 0]
+
+        sum_matched_intensities = float(columns['sum_matched_intensities'][row])
+        log_sum = math.log10(sum_matched_intensities) if sum_matched_intensities > 0 else 0
+
+        decision, label = class_label(psm)
+
+        return ([mascot_score, "UNDEFINED", spectrum.charge, spectrum.sumI,
+                 float(columns['highest_intensity'][row]) / float(columns['intensity_sum'][row]),
+                 len(psm.modifications), len(psm.sequence), len(psm.modifications) / len(psm.sequence),
+                 float(spectrum.pepmass), psm.calculatedMassToCharge,
+                 float(columns['dm_dalton'][row]), float(columns['dm_ppm'][row]),
+                 sum_matched_intensities, log_sum] + ratios + counts +
+                [int(longest) for longest in columns['longest'][row]] +
+                [float(columns['median_error'][row]), float(columns['mean_error'][row]),
+                 float(columns['iqr_error'][row]), label, decision])
+
+
+def calculate_batch_features(psms, spectra, upperthreshold, lowerthreshold):
+    """
+    Calculates the features of many psms in one compiled pass. The fragment
+    ladders from the ladder cache and the peaks are concatenated into flat
+    arrays, spectra shared by several psms are included once. The intensity
+    statistics are taken from the spectra, which calculate them once.
+
+    Parameters
+    ----------
+    psms: list
+        PSMRow objects, the scores of a PSMTable are needed
+    spectra: list
+        Spectrum of every psm
+    upperthreshold: float
+        upper threshold of a fragment match
+    lowerthreshold: float
+        lower threshold of a fragment match
+
+    Returns
+    -------
+    FeatureTable
+        features of the psms
+
+    """
+    ladders = []
+    ladder_offsets = [0]
+    spectrum_rows = []
+    spectrum_ids = dict()
+    peaks = []
+    peak_offsets = [0]
+    parsed = numpy.ones(len(psms), dtype=numpy.bool_)
+
+    mods = [modification_vector(psm.sequence, psm.modifications) for psm in psms]
+    rows = [row for row in range(len(psms)) if mods[row] is not None]
+    psm_ladders = [None] * len(psms)
+    for row, peptide_ladders in zip(rows, ladder_cache.batch_ladders([psms[row].sequence for row in rows], [mods[row] for row in rows])):
+        if peptide_ladders is None:
+            log.error("Unknown residue in sequence! {0}".format(psms[row].sequence))
+        psm_ladders[row] = peptide_ladders
+
+    for row, (psm, spectrum) in enumerate(zip(psms, spectra)):
+        if psm_ladders[row] is None:
+            parsed[row] = False
+            ladder_offsets.append(ladder_offsets[-1])
+        else:
+            (bplus, yplus), (bplusplus, yplusplus) = psm_ladders[row]
+            ladders.extend((bplus, bplusplus, yplus, yplusplus))
+            ladder_offsets.append(ladder_offsets[-1] + 4 * len(bplus))
+
+        spectrum_row = spectrum_ids.get(id(spectrum))
+        if spectrum_row is None:
+            spectrum_row = spectrum_ids[id(spectrum)] = len(peaks)
+            peaks.append(spectrum)
+            peak_offsets.append(peak_offsets[-1] + len(spectrum.mz))
+        spectrum_rows.append(spectrum_row)
+
+    mz = numpy.concatenate([spectrum.mz for spectrum in peaks]).astype(numpy.float64) if peaks else numpy.empty(0)
+    intensity = numpy.concatenate([spectrum.intensity for spectrum in peaks]).astype(numpy.float64) if peaks else numpy.empty(0)
+    highest_intensities = numpy.array([spectrum.highest_intensity for spectrum in peaks], dtype=numpy.float64)
+    intensity_sums = numpy.array([spectrum.intensity_sum for spectrum in peaks], dtype=numpy.float64)
+
+    counts = numpy.zeros((len(psms), 4), dtype=numpy.int64)
+    longest = numpy.zeros((len(psms), 4), dtype=numpy.int64)
+    statistics = numpy.zeros((len(psms), 5))
+    error_offsets = numpy.zeros(len(psms) + 1, dtype=numpy.int64)
+    error_values = _batch_kernel(numpy.concatenate(ladders) if ladders else numpy.empty(0), numpy.array(ladder_offsets, dtype=numpy.int64),
+                  mz, intensity, numpy.array(peak_offsets, dtype=numpy.int64), highest_intensities, intensity_sums,
+                  numpy.array(spectrum_rows, dtype=numpy.int64), float(upperthreshold), float(lowerthreshold),
+                  _COMPENSATED_SUM, counts, longest, statistics, error_offsets)
+
+    calculated_mz = numpy.array([psm.calculatedMassToCharge for psm in psms], dtype=numpy.float64)
+    pepmass = numpy.array([spectrum.pepmass for spectrum in spectra], dtype=numpy.float64)
+    dm_dalton = calculated_mz - pepmass
+
+    columns = {
+        'counts': counts,
+        'longest': longest,
+        'highest_intensity': statistics[:, 0],
+        'intensity_sum': statistics[:, 1],
+        'sum_matched_intensities': statistics[:, 2],
+        'mean_error': statistics[:, 3],
+        'median_error': statistics[:, 4],
+        'iqr_error': _interquartile_ranges(error_values, error_offsets),
+        'dm_dalton': dm_dalton,
+        'dm_ppm': (dm_dalton / calculated_mz) * 1000000.0,
+    }
+    # matching errors exist once a fragment matched
+    valid = parsed & (counts.sum(axis=1) > 0)
+    return FeatureTable(psms, spectra, columns, valid)
@@ -5,8 +5,13 @@ import logging
 import sys
 import time
 import datetime
+import itertools
+from collections import OrderedDict
 from numba import jit
 from pyteomics import mass
+from pyteomics.auxiliary import PyteomicsError
+
+from parsers.psm_table import AMBIGUOUS_RESIDUES
 
 from features.psm_labeler import class_label
 
@@ -16,6 +21,24 @@ log = logging.getLogger("PrideData")
 mass_water = mass.calculate_mass(formula='H2O')
 mass_hydrogen = mass.calculate_mass(formula='H')
 
+# peptide forms whose ladders are kept by a process
+LADDER_CACHE_SIZE = 20000
+
+def _residue_mass_table():
+    table = numpy.full(256, numpy.nan)
+    for residue in mass.std_aa_mass:
+        if len(residue) == 1 and residue not in AMBIGUOUS_RESIDUES:
+            table[ord(residue)] = mass.fast_mass(residue)
+    return table
+
+# mass of every amino acid by its byte code like fast_mass calculates it,
+# NaN for unknown residues and the ambiguous residues make_result rejects
+RESIDUE_MASSES = _residue_mass_table()
+
+def _residue_codes(sequence):
+    # one byte per residue, other characters become '?' which has no mass
+    return numpy.frombuffer(sequence.encode('ascii', 'replace'), dtype=numpy.uint8)
+
 # transforming sequences to masssequences
 # sequence is converted to list containing each amino acids mass
 def transform_sequence_to_masssequence(sequence, mods):
@@ -35,73 +58,75 @@ def transform_sequence_to_masssequence(sequence, mods):
         masses of indices
     """
 
-    mass_sequence = []
-    index = 0
-    for i in sequence:
-        mass_sequence.append(mass.fast_mass(i) + mods[index])
-        index += 1
-    return mass_sequence
-
-# b series implementation using numba
+    masses = RESIDUE_MASSES[_residue_codes(sequence)]
+    unknown = numpy.flatnonzero(numpy.isnan(masses))
+    if len(unknown):
+        raise PyteomicsError('No mass data for residue: ' + sequence[unknown[0]])
+    return (masses + numpy.array(mods, dtype=numpy.float64)).tolist()
 
+def sequences_to_masssequences(sequences, mods):
+    """
+    Amino acids sequences of many peptides to masssequences in one call
 
-@jit(nopython=True)
-def calculate_b_Series(sequence, charge):
-    """ 
-    Calculate b series for given sequence relative to charge 
-    
     Parameters
     ----------
-    sequence: list
-        Sequence of masses from peptide
-    charge: int
-        Charge of peptide
+    sequences: list
+        Sequences of the peptides
+    mods: list
+        Modification mass per residue of every peptide
 
     Returns
     -------
-    list
-        b series
+    tuple
+        masses of all residues, offsets delimiting the peptides and whether
+        every residue of a peptide has a mass, sequences with unknown or
+        ambiguous residues (X, B, Z, J) are not valid
     """
+    offsets = numpy.zeros(len(sequences) + 1, dtype=numpy.int64)
+    numpy.cumsum([len(sequence) for sequence in sequences], out=offsets[1:])
 
-    b_series = []
-    b_series.append(
-        (sequence[0] + charge * mass_hydrogen - mass_water) / charge)
-
-    for i in range(1, len(sequence)):
-        b_series.append((b_series[i-1] + (sequence[i] - mass_water) / charge))
+    masses = RESIDUE_MASSES[_residue_codes(''.join(sequences))]
+    masses += numpy.fromiter(itertools.chain.from_iterable(mods), dtype=numpy.float64, count=len(masses))
 
-    return b_series
+    unknown = numpy.zeros(len(masses) + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.isnan(masses), out=unknown[1:])
+    valid = unknown[offsets[1:]] == unknown[offsets[:-1]]
+    return masses, offsets, valid
 
-# y series implementation using numba
-@jit(nopython=True)
-def calculate_y_Series(sequence, charge):
+@jit(nopython=True, cache=True)
+def fragment_ladders(sequence, charge):
     """ 
-    Calculate y series for given sequence relative to charge 
+    Calculate b and y series for given sequence relative to charge in one pass 
     
     Parameters
     ----------
-    sequence: list
+    sequence: numpy.ndarray
         Sequence of masses from peptide
     charge: int
         Charge of peptide
 
     Returns
     -------
-    list
-        b series
+    tuple
+        b series and y series as arrays
     """
 
-    y_series = [0.0] * len(sequence)
-    y_series[0] = ((sequence[len(sequence)-1] +
-                    charge * mass_hydrogen) / charge)
+    if len(sequence) == 0:
+        raise IndexError("empty mass sequence")
 
+    b_series = numpy.empty(len(sequence))
+    b_series[0] = (sequence[0] + charge * mass_hydrogen - mass_water) / charge
+    for i in range(1, len(sequence)):
+        b_series[i] = b_series[i-1] + (sequence[i] - mass_water) / charge
+
+    y_series = numpy.empty(len(sequence))
+    y_series[0] = (sequence[len(sequence)-1] + charge * mass_hydrogen) / charge
     index = 1
     for i in range(len(sequence)-2, -1, -1):
-        y_series[index] = (
-            (y_series[index-1] + (sequence[i] - mass_water) / charge))
+        y_series[index] = y_series[index-1] + (sequence[i] - mass_water) / charge
         index += 1
 
-    return y_series
+    return b_series, y_series
 
 @jit(nopython=True)
 def dm_dalton_ppm(calculated_mass, experimental_mass):
@@ -168,93 +193,336 @@ def median(array):
     elif len(array) % 2 == 0:
         return (array[int(len(array) / 2) - 1] + array[int(len(array) / 2)])/2
 
-@jit(nopython=True)
-def match_series_and_spectrum(series, zipped_data, upperthreshold, lowerthreshold):
+@jit(nopython=True, cache=True)
+def search_sorted(values, begin, end, value, right):
     """ 
-    matches a y or b series to a sorted and zipped spectrum (m/z, intensities)
+    Binary search in a sorted range of an array 
     
     Parameters
     ----------
-    series: list
-        list of floats representing a masses
-    zipped_data: tuple
-        tuple of data containing intensities and masses
+    values: numpy.ndarray
+        sorted values
+    begin: int
+        first index of the range
+    end: int
+        index after the range
+    value: float
+        searched value
+    right: bool
+        finds the first value greater than value instead of the first value not smaller
+
+    Returns
+    -------
+    int
+        index in begin:end+1
+    """
+    while begin < end:
+        middle = (begin + end) // 2
+        if values[middle] < value or (right and values[middle] == value):
+            begin = middle + 1
+        else:
+            end = middle
+    return begin
+
+@jit(nopython=True, cache=True)
+def match_fragments(series, length, mz, intensity, begin, end, upperthreshold, lowerthreshold,
+                    matched_peaks, matched_intensities, errors, error_count):
+    """ 
+    matches a y or b series to the sorted peaks begin:end of a spectrum, writing into buffers 
+
+    Each peak above the window of the current fragment moves on to the next
+    fragment, so the first peak above a window is found by binary search and
+    the peaks of a window are a contiguous range. A fragment which matched and
+    is passed adds an error of 0.
+    
+    Parameters
+    ----------
+    series: numpy.ndarray
+        masses of the fragments
+    length: int
+        number of fragments in series
+    mz: numpy.ndarray
+        m/z values sorted in begin:end
+    intensity: numpy.ndarray
+        intensities of the peaks
+    begin: int
+        first peak of the spectrum
+    end: int
+        peak after the spectrum
     upperthreshold: float
         upper threshold of a match
     lowerthreshold: float
         lower threshold of a match
+    matched_peaks: numpy.ndarray
+        buffer receiving the m/z of the matched peaks
+    matched_intensities: numpy.ndarray
+        buffer receiving the intensities of the matched peaks
+    errors: numpy.ndarray
+        buffer receiving the matching errors from error_count on
+    error_count: int
+        number of errors in errors
 
     Returns
     -------
     tuple
+        number of matched peaks, longest series and the new number of errors
     """
-
-    matched_peaks = []
-    matched_intensities = []
-    matching_errors = []
-
+    matches = 0
     longest_series = 0
-
-    series_index = 0
     current_series = 0
     matched = False
-    upper = series[series_index] + upperthreshold
-    lower = series[series_index] - lowerthreshold
-    for index in range(0, len(zipped_data)):
-
-        if zipped_data[index][0] > upper and (series_index
-         + 1) < len(series):
-            if(matched):
-                current_series += 1
-                if current_series > longest_series:
-                    longest_series = current_series
-                matched = False
-                error = 0
-                matching_errors.append(error)
-            else:
-                current_series = 0
-            series_index += 1
-            upper = series[series_index] + upperthreshold
-            lower = series[series_index] - lowerthreshold
-
-        if zipped_data[index][0] <= upper and zipped_data[index][0] >= lower:
-            matched_peaks.append(zipped_data[index][0])
-            matched_intensities.append(zipped_data[index][1])
-            matching_errors.append(abs(series[series_index] - zipped_data[index][0]))
+
+    series_index = 0
+    index = begin
+    while index < end:
+        upper = series[series_index] + upperthreshold
+        lower = series[series_index] - lowerthreshold
+
+        above = search_sorted(mz, index, end, upper, True)
+        for i in range(max(index, search_sorted(mz, index, above, lower, False)), above):
+            matched_peaks[matches] = mz[i]
+            matched_intensities[matches] = intensity[i]
+            matches += 1
+            errors[error_count] = abs(series[series_index] - mz[i])
+            error_count += 1
+            matched = True
+
+        if above == end or series_index + 1 >= length:
+            break
+
+        # the first peak above the window moves on to the next fragment
+        if matched:
+            current_series += 1
+            if current_series > longest_series:
+                longest_series = current_series
+            matched = False
+            errors[error_count] = 0.0
+            error_count += 1
+        else:
+            current_series = 0
+        series_index += 1
+
+        upper = series[series_index] + upperthreshold
+        lower = series[series_index] - lowerthreshold
+        if mz[above] <= upper and mz[above] >= lower:
+            matched_peaks[matches] = mz[above]
+            matched_intensities[matches] = intensity[above]
+            matches += 1
+            errors[error_count] = abs(series[series_index] - mz[above])
+            error_count += 1
             matched = True
+        index = above + 1
 
-    return matched_peaks, matched_intensities, longest_series, matching_errors
+    return matches, longest_series, error_count
 
-@jit(nopython=True)
-def spectrum_statistics(zipped_data):
+@jit(nopython=True, cache=True)
+def match_series_and_spectrum(series, mz, intensity, upperthreshold, lowerthreshold):
     """ 
-    calculates highest intensity and sum of intensities 
+    matches a y or b series to a spectrum sorted by m/z
     
     Parameters
     ----------
-    zipped_data: tuple
-        tuple of data containing intensities and masses
+    series: numpy.ndarray
+        masses of the fragments
+    mz: numpy.ndarray
+        sorted m/z values of the peaks
+    intensity: numpy.ndarray
+        intensities of the peaks
+    upperthreshold: float
+        upper threshold of a match
+    lowerthreshold: float
+        lower threshold of a match
 
     Returns
     -------
     tuple
-        highest intensities and sum of intensities
+        matched peaks, their intensities, longest series and matching errors
+    """
+    matched_peaks = numpy.empty(len(mz))
+    matched_intensities = numpy.empty(len(mz))
+    errors = numpy.empty(len(mz) + len(series))
+
+    matches, longest_series, error_count = match_fragments(
+        series, len(series), mz, intensity, 0, len(mz), upperthreshold, lowerthreshold,
+        matched_peaks, matched_intensities, errors, 0)
+
+    return matched_peaks[:matches], matched_intensities[:matches], longest_series, errors[:error_count]
+
+def modification_vector(sequence, modifications):
+    """ 
+    Modification mass per residue of a peptide 
+    
+    Parameters
+    ----------
+    sequence: str
+        Sequence of a peptide
+    modifications: list
+        (monoisotopicMassDelta, location) of the peptide
+
+    Returns
+    -------
+    list
+        modification masses, None if a location lies behind the sequence
+    """
+    mods = [0.0] * len(sequence)
+    for i in modifications:
+        index = i[1]-1
+        if not index >= len(mods):
+            mods[index] = i[0]
+        else:
+            log.error("Modification location larger than sequence! len: {0} location: {1}".format(len(mods), index)) 
+            return None
+    return mods
+
+class LadderCache(object):
+    """ 
+    Least recently used cache of b and y ladders keyed by sequence, modification
+    vector and charge. A process keeps one cache for all psms it calculates,
+    hits and misses count the lookups to size it.
     """
-    highest_intensity = 0.0
-    intensity_sum = 0.0
 
-    for i in range(0, len(zipped_data)):
+    def __init__(self, max_size=LADDER_CACHE_SIZE):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._ladders = OrderedDict()
+        # the charges of a peptide are looked up one after the other
+        self._last_masses = (None, None)
+
+    def __len__(self):
+        return len(self._ladders)
+
+    def ladders(self, sequence, mods, charge):
+        """ 
+        Returns the b and y ladders of a peptide, calculated on a miss 
+        
+        Parameters
+        ----------
+        sequence: str
+            Sequence of a peptide
+        mods: list
+            modification mass per residue
+        charge: int
+            Charge of the fragments
+
+        Returns
+        -------
+        tuple
+            b series and y series as numpy arrays
+        """
+        peptide = (sequence, tuple(mods))
+        key = peptide + (charge,)
+        ladders = self._ladders.get(key)
+        if ladders is not None:
+            self.hits += 1
+            self._ladders.move_to_end(key)
+            return ladders
+
+        self.misses += 1
+        if self._last_masses[0] != peptide:
+            self._last_masses = (peptide, numpy.array(transform_sequence_to_masssequence(sequence, mods)))
+        ladders = fragment_ladders(self._last_masses[1], charge)
+        self._store(key, ladders)
+        return ladders
+
+    def batch_ladders(self, sequences, mods, charges=(1, 2)):
+        """ 
+        Returns the b and y ladders of many peptides, the mass sequences of all
+        missed peptides are calculated in one call 
+        
+        Parameters
+        ----------
+        sequences: list
+            Sequences of the peptides
+        mods: list
+            modification mass per residue of every peptide
+        charges: tuple
+            Charges of the fragments
+
+        Returns
+        -------
+        list
+            per peptide a list of (b series, y series) per charge, None if the
+            sequence has unknown or ambiguous residues
+        """
+        peptides = [(sequence, tuple(peptide_mods)) for sequence, peptide_mods in zip(sequences, mods)]
+        found = dict()
+        missed = dict()
+        for peptide in peptides:
+            for charge in charges:
+                key = peptide + (charge,)
+                if key in found:
+                    # calculated once per batch like a later lookup would find it
+                    self.hits += 1
+                    continue
+                ladders = self._ladders.get(key)
+                if ladders is not None:
+                    self.hits += 1
+                    self._ladders.move_to_end(key)
+                else:
+                    self.misses += 1
+                    missed.setdefault(peptide, len(missed))
+                found[key] = ladders
+
+        masses, offsets, valid = sequences_to_masssequences([peptide[0] for peptide in missed],
+                                                            [peptide[1] for peptide in missed])
+        for peptide, index in missed.items():
+            if not valid[index] or offsets[index] == offsets[index + 1]:
+                continue
+            for charge in charges:
+                key = peptide + (charge,)
+                if found[key] is None:
+                    found[key] = fragment_ladders(masses[offsets[index]:offsets[index + 1]], charge)
+                    self._store(key, found[key])
+
+        results = []
+        for peptide in peptides:
+            ladders = [found[peptide + (charge,)] for charge in charges]
+            results.append(None if ladders[0] is None else ladders)
+        return results
+
+    def _store(self, key, ladders):
+        self._ladders[key] = ladders
+        if len(self._ladders) > self.max_size:
+            self._ladders.popitem(last=False)
+
+    def resize(self, max_size):
+        """ 
+        Changes the number of kept ladders, the least recently used are dropped 
+        """
+        self.max_size = max_size
+        while len(self._ladders) > self.max_size:
+            self._ladders.popitem(last=False)
 
-        intensity_sum += zipped_data[i][1]
+    def hit_rate(self):
+        """ 
+        Share of lookups answered from the cache 
 
-        if zipped_data[i][1] > highest_intensity:
-            highest_intensity = zipped_data[i][1]
+        Returns
+        -------
+        float
+            hits per lookup, 0 before the first lookup
+        """
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
 
-    return highest_intensity, intensity_sum
+# ladders shared by the psms of this process
+ladder_cache = LadderCache()
 
 class FeatureList(object):
     """ 
     Represents features of psms 
+
+    Parameters
+    ----------
+    mzid: PSMRow
+        row of a psm table, the scores of a PSMTable are needed
+    mgf: Spectrum
+        spectrum of the psm
+    upperthreshold: float
+        upper threshold of a fragment match
+    lowerthreshold: float
+        lower threshold of a fragment match
     """
 
     def __init__(self, mzid, mgf, upperthreshold, lowerthreshold):
@@ -277,40 +545,35 @@ class FeatureList(object):
         sequence = self.mzid.sequence
         modifications = self.mzid.modifications
 
-        zipped_spectrum = zip(self.mgf['mz_list'], self.mgf['intensity_list']) 
-    
-        mods = [0.0] * len(sequence)
-        for i in modifications:
-            index = i[1]-1
-            if not index >= len(mods):
-                mods[index] = i[0]
-            else:
-                log.error("Modification location larger than sequence! len: {0} location: {1}".format(len(mods), index)) 
-                return None
+        mods = modification_vector(sequence, modifications)
+        if mods is None:
+            return None
 
         decision, label = class_label(self.mzid)
 
-        dm_dalton, dm_ppm = dm_dalton_ppm(self.mzid.calculatedMassToCharge, self.mgf['pepmass'])
+        dm_dalton, dm_ppm = dm_dalton_ppm(self.mzid.calculatedMassToCharge, self.mgf.pepmass)
 
-        self.masssequence = transform_sequence_to_masssequence(sequence, mods)
-        self.zipped_data = sorted(zipped_spectrum, key=lambda x: x[0])
+        # peaks of a Spectrum are sorted by m/z at parse time, its statistics are shared by its psms
+        self.highest_intensity, self.intensity_sum = self.mgf.statistics()
+        mz = self.mgf.mz
+        intensity = self.mgf.intensity
+        bplus, yplus = ladder_cache.ladders(sequence, mods, 1)
+        bplusplus, yplusplus = ladder_cache.ladders(sequence, mods, 2)
 
-        self.highest_intensity, self.intensity_sum = spectrum_statistics(self.zipped_data)
-        #print(self.zipped_data)
         self.bplus_peaks, self.bplus_int, self.bplus_series, bplus_errors = match_series_and_spectrum(
-            calculate_b_Series(self.masssequence, 1), self.zipped_data, self.upperthreshold, self.lowerthreshold)
+            bplus, mz, intensity, self.upperthreshold, self.lowerthreshold)
 
         self.yplus_peaks, self.yplus_int, self.yplus_series, bplusplus_errors = match_series_and_spectrum(
-            calculate_y_Series(self.masssequence, 1), self.zipped_data, self.upperthreshold, self.lowerthreshold)
+            yplus, mz, intensity, self.upperthreshold, self.lowerthreshold)
 
         self.bplusplus_peaks, self.bplusplus_int, self.bplusplus_series, yplus_errors = match_series_and_spectrum(
-            calculate_b_Series(self.masssequence, 2), self.zipped_data, self.upperthreshold, self.lowerthreshold)
+            bplusplus, mz, intensity, self.upperthreshold, self.lowerthreshold)
 
         self.yplusplus_peaks, self.yplusplus_int, self.yplusplus_series, ypluplus_errors = match_series_and_spectrum(
-            calculate_y_Series(self.masssequence, 2), self.zipped_data,
-             self.upperthreshold, self.lowerthreshold)
+            yplusplus, mz, intensity, self.upperthreshold, self.lowerthreshold)
 
-        matching_errors = sorted(bplus_errors + bplusplus_errors + yplus_errors + ypluplus_errors)
+        # python floats like the lists the matching returned before
+        matching_errors = sorted(bplus_errors.tolist() + bplusplus_errors.tolist() + yplus_errors.tolist() + ypluplus_errors.tolist())
         #print(matching_errors)
         if len(matching_errors) > 0:
             self.mean_matching_error = mean(matching_errors)
@@ -322,7 +585,7 @@ class FeatureList(object):
             self.yplus_matches = len(self.yplus_peaks)
             self.yplusplus_matches = len(self.yplusplus_peaks)
             self.matches = len(self.bplus_peaks) + len(self.bplusplus_peaks) + len(self.yplus_peaks) + len(self.yplusplus_peaks)
-            self.sum_matched_intensities = sum(self.bplus_int) + sum(self.bplusplus_int) + sum(self.yplus_int) + sum(self.yplusplus_int)
+            self.sum_matched_intensities = sum(self.bplus_int.tolist()) + sum(self.bplusplus_int.tolist()) + sum(self.yplus_int.tolist()) + sum(self.yplusplus_int.tolist())
             
             if self.sum_matched_intensities > 0:
                 self.log_sum_matched_intensities = math.log10(self.sum_matched_intensities)
@@ -340,21 +603,19 @@ class FeatureList(object):
                 self.yplus_ratio = 0
                 self.yplusplus_ratio = 0
 
-            mascot_score = 0
-            for param in self.mzid.parameters:
-                if 'Mascot:score' == param[0]:
-                    mascot_score = param[1]
-           # log.info(self.mzid.parameters)
+            mascot_score = self.mzid.score('mascot_score')
+            if math.isnan(mascot_score):
+                mascot_score = 0
 
             self.dictionary = { "Hyperscore": mascot_score, 
                                 "Domain_Id": "UNDEFINED",
-                                "Charge": self.mgf['charge'],
-                                "sumI": sum(self.mgf['intensity_list']), 
+                                "Charge": self.mgf.charge,
+                                "sumI": self.mgf.sumI, 
                                 "norm_high_peak_intensity": self.highest_intensity/self.intensity_sum, # int highest peak / sum of intensities
                                 "Num_of_Modifications": len(self.mzid.modifications),
                                 "Pep_Len": len(self.mzid.sequence),
                                 "Num_Pl": len(self.mzid.modifications)/len(self.mzid.sequence), # num of mods / peptide length
-                                "mh(group)": float(self.mgf['pepmass']), # m + h mass experimental
+                                "mh(group)": float(self.mgf.pepmass), # m + h mass experimental
                                 "mh(domain)": self.mzid.calculatedMassToCharge, # m + h mass calculated
                                 "uniqueDM": dm_dalton,
                                 "uniqueDMppm": dm_ppm,
@@ -1,11 +1,14 @@
+import math
+
+
 def class_label(mzid):
     """
     Inferes a class label based on predefined conditions.
     
     Parameters
     ----------
-    mzid: _Result
-        mzid result object
+    mzid: PSMRow
+        row of a psm table
     
     Returns
     -------
@@ -13,28 +16,20 @@ def class_label(mzid):
         Contains the label and the rule used for the label decision.
     """
 
-    mascot_score = -999
-    mascot_threshold = -999
-
-   # print(mzid.parameters)
-    for param in mzid.parameters:
-
-        if 'Mascot:identity threshold' == param[0]:
-            mascot_threshold = param[1]
-
-        elif 'Mascot:score' == param[0]:
-            mascot_score = param[1]
+    scaffold_probability = mzid.score('scaffold_probability')
+    if not math.isnan(scaffold_probability):
+        if scaffold_probability >= 0.99:
+            return 'scaffold', 'true'
+        else:
+            return 'scaffold', 'false'
 
-        elif 'Scaffold:Peptide Probability' == param[0]:
-            if float(param[1]) >= 0.99:
-                return 'scaffold', 'true'
-            elif float(param[1]) < 0.99:
-                return 'scaffold', 'false'
+    mascot_score = mzid.score('mascot_score')
+    mascot_threshold = mzid.score('mascot_threshold')
 
-    if mascot_score != -999 and mascot_threshold != -999:
+    if not (math.isnan(mascot_score) or math.isnan(mascot_threshold)):
         if mascot_score >= mascot_threshold:
             return 'mascot', 'true'
-        elif mascot_score < mascot_threshold:
+        else:
             return 'mascot', 'false'
 
     if int(mzid.rank) == 1:
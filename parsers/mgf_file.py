@@ -1,4 +1,9 @@
 import re
+import numpy
+from numba import jit
+
+from utils import open_file
+from parsers.spectrum import Spectrum
 
 def generate_mgf_list(input_file):
     """ 
@@ -7,7 +12,7 @@ def generate_mgf_list(input_file):
     Parameters
     ----------
     input_file: str
-        path to mgf file
+        path to a plain or gzip compressed mgf file
 
     Returns
     -------
@@ -15,7 +20,7 @@ def generate_mgf_list(input_file):
         lines in an mgf file
 
     """ 
-    with open(input_file, 'r') as mgf_file:
+    with open_file(input_file, 'r') as mgf_file:
         mgf_list = mgf_file.read().split('\n')
     return mgf_list
 
@@ -49,67 +54,390 @@ def get_mgf_tokens(mgf_list):
     return tokens
 
 
-def parse_mgf(input_file):
+# bytes read from an mgf per chunk
+MGF_CHUNK_SIZE = 4 * 1024 * 1024
+
+# charge annotation following the intensity of a peak, e.g. 2+
+_PEAK_CHARGE = re.compile(rb'(?<=\d)[+-](?=\s|$)')
+
+
+def iter_spectrum_spans(mgf_file, chunk_size=MGF_CHUNK_SIZE):
     """ 
-    Parses MGF by calculating offsets and indexing individual lines in an MGF 
+    Splits an MGF into the raw bytes between BEGIN IONS and END IONS and their offsets 
     
     Parameters
     ----------
-    input_file : str
-        path to an mgf
+    mgf_file : file
+        mgf opened in binary mode
+    chunk_size : int
+        number of bytes read at once
+
+    Yields
+    ------
+    tuple
+        byte offset of the spectrum content in the file and the content
+        without the BEGIN IONS and END IONS lines
+
+    """
+    buffer = b''
+    # file offset of the first byte in the buffer
+    buffer_offset = 0
+    position = 0
+    searched = 0
+    eof = False
+
+    while True:
+        end = buffer.find(b'END IONS', searched)
+        if end < 0:
+            if eof:
+                break
+            chunk = mgf_file.read(chunk_size)
+            eof = not chunk
+            # drop consumed bytes only when new data arrives
+            searched = max(len(buffer) - position - 8, 0)
+            buffer_offset += position
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+
+        begin = buffer.rfind(b'BEGIN IONS', position, end)
+        if begin >= 0:
+            yield buffer_offset + begin + 10, buffer[begin + 10:end]
+        position = end + 8
+        searched = position
+
+
+def iter_spectrum_blocks(mgf_file, chunk_size=MGF_CHUNK_SIZE):
+    """ 
+    Splits an MGF into the raw bytes between BEGIN IONS and END IONS 
+    
+    Parameters
+    ----------
+    mgf_file : file
+        mgf opened in binary mode
+    chunk_size : int
+        number of bytes read at once
+
+    Yields
+    ------
+    bytes
+        content of a spectrum without the BEGIN IONS and END IONS lines
+
+    """
+    for _, block in iter_spectrum_spans(mgf_file, chunk_size):
+        yield block
+
+
+# exactly representable powers of ten
+_POWERS_OF_TEN = numpy.array([10.0 ** exponent for exponent in range(23)])
+
+
+@jit(nopython=True, cache=True)
+def scan_peaks(data, mz, intensity):
+    """ 
+    Tokenizes a peak list byte by byte into m/z and intensity arrays. Numbers
+    are converted as integer mantissa and power of ten, which is exact for up
+    to 15 significant digits and exponents up to 22. Other input is rejected.
+    
+    Parameters
+    ----------
+    data: numpy.ndarray
+        bytes of the peak lines as uint8
+    mz: numpy.ndarray
+        output array of m/z values, one entry per line
+    intensity: numpy.ndarray
+        output array of intensities, one entry per line
+
+    Returns
+    -------
+    int
+        number of peaks or -1 if the peak list has to be parsed otherwise
+    """
+    length = len(data)
+    index = 0
+    peak = 0
+    column = 0
+
+    while index < length:
+        char = data[index]
+
+        # line end
+        if char == 10:
+            if column == 1:
+                return -1
+            if column > 1:
+                peak += 1
+            column = 0
+            index += 1
+            continue
+
+        # column separators
+        if char == 32 or char == 9 or char == 13:
+            index += 1
+            continue
+
+        negative = False
+        if char == 45 or char == 43:
+            negative = char == 45
+            index += 1
+
+        mantissa = 0
+        digits = 0
+        exponent = 0
+        while index < length and 48 <= data[index] <= 57:
+            mantissa = mantissa * 10 + (data[index] - 48)
+            digits += 1
+            index += 1
+        if index < length and data[index] == 46:
+            index += 1
+            while index < length and 48 <= data[index] <= 57:
+                mantissa = mantissa * 10 + (data[index] - 48)
+                digits += 1
+                exponent -= 1
+                index += 1
+        if digits == 0 or digits > 15:
+            return -1
+
+        if index < length and (data[index] == 101 or data[index] == 69):
+            index += 1
+            exponent_negative = False
+            if index < length and (data[index] == 45 or data[index] == 43):
+                exponent_negative = data[index] == 45
+                index += 1
+            exponent_digits = 0
+            power = 0
+            while index < length and 48 <= data[index] <= 57:
+                power = power * 10 + (data[index] - 48)
+                exponent_digits += 1
+                index += 1
+            if exponent_digits == 0 or exponent_digits > 3:
+                return -1
+            exponent += -power if exponent_negative else power
+
+        if exponent < -22 or exponent > 22:
+            return -1
+        if exponent < 0:
+            value = mantissa / _POWERS_OF_TEN[-exponent]
+        else:
+            value = mantissa * _POWERS_OF_TEN[exponent]
+        if negative:
+            value = -value
+
+        # charge annotation of a peak, e.g. 2+
+        if index < length and (data[index] == 43 or data[index] == 45):
+            if column < 2:
+                return -1
+            index += 1
+        if index < length and not (data[index] == 32 or data[index] == 9 or data[index] == 13 or data[index] == 10):
+            return -1
+
+        if column == 0:
+            mz[peak] = value
+        elif column == 1:
+            intensity[peak] = value
+        column += 1
+
+    if column == 1:
+        return -1
+    if column > 1:
+        peak += 1
+    return peak
+
+
+def parse_peaks_linewise(peaks):
+    """ 
+    Parses a peak list one line at a time 
+    
+    Parameters
+    ----------
+    peaks : bytes
+        peak lines of a spectrum
 
     Returns
     -------
     tuple
-        entries in the mgf and tokens of the mgf
+        m/z and intensity lists
 
     """
+    mz_lst = []
+    intensity_lst = []
+    for line in peaks.split(b'\n'):
+        line_split = line.split()
+        if line_split:
+            mz_lst.append(float(line_split[0]))
+            intensity_lst.append(float(line_split[1]))
+    return mz_lst, intensity_lst
 
-    entries = dict()
-    mgf_list = generate_mgf_list(input_file)
-    tokens = get_mgf_tokens(mgf_list)
 
-    index = 0
-    spectrum_mgf_index = 0
-    line = mgf_list[index]
+def parse_peaks(peaks):
+    """ 
+    Parses a peak list in one numeric pass. Columns may be separated by tabs or
+    spaces, a third charge column is accepted. Peak lists the tokenizer rejects
+    are parsed by numpy and as a last resort line by line.
+    
+    Parameters
+    ----------
+    peaks : bytes
+        peak lines of a spectrum
 
-    while index < len(mgf_list):
-        line = mgf_list[index]
+    Returns
+    -------
+    tuple
+        m/z and intensity arrays
 
-        if 'BEGIN IONS' in line:
+    """
+    peaks = peaks.strip()
+    if not peaks:
+        return numpy.empty(0), numpy.empty(0)
 
-            attributes = dict()
-            try:
-                line = mgf_list[index + tokens['TITLE']]
-                attributes['title'] = re.sub(r'TITLE=', '', line)
+    lines = peaks.count(b'\n') + 1
+    mz = numpy.empty(lines)
+    intensity = numpy.empty(lines)
+    count = scan_peaks(numpy.frombuffer(peaks, dtype=numpy.uint8), mz, intensity)
+    if count >= 0:
+        return mz[:count], intensity[:count]
 
-                line = mgf_list[index + tokens['PEPMASS']]
-                attributes['pepmass'] = float(re.sub(r'PEPMASS=', '', line))
+    first_line_end = peaks.find(b'\n')
+    columns = len(peaks[:first_line_end if first_line_end >= 0 else len(peaks)].split())
 
-                line = mgf_list[index + tokens['CHARGE']]
-                attributes['charge'] = int(re.match(r'CHARGE=(\d)\+', line)[1] if re.match(r'CHARGE=(\d)\+', line) else 0)
-                
-                spectrum_index = index + tokens['LISTS']
-                line = mgf_list[spectrum_index]
-            except KeyError:
-                return dict(), list()
-            mz_lst = []
-            intensity_lst = []
-            while not 'END IONS' in line:
-                line_split = line.split('\t')
-                mz_lst.append(float(line_split[0].strip()))
-                intensity_lst.append(float(line_split[1].strip()))
-                spectrum_index += 1
-                line = mgf_list[spectrum_index]
+    if columns >= 2:
+        if columns > 2:
+            peaks = _PEAK_CHARGE.sub(b'', peaks)
+        try:
+            values = numpy.fromstring(peaks, dtype=numpy.float64, sep=' ')
+        except ValueError:
+            values = None
 
-            attributes['mz_list'] = mz_lst
-            attributes['intensity_list'] = intensity_lst
+        if values is not None and values.size == lines * columns:
+            values = values.reshape(lines, columns)
+            return values[:, 0].copy(), values[:, 1].copy()
 
-            entries['index='+str(spectrum_mgf_index)] = attributes
+    mz_lst, intensity_lst = parse_peaks_linewise(peaks)
+    return numpy.array(mz_lst), numpy.array(intensity_lst)
 
-            spectrum_mgf_index += 1
 
-        index += 1
+def parse_spectrum_header(block):
+    """ 
+    Reads the header lines of a spectrum 
+    
+    Parameters
+    ----------
+    block : bytes
+        content of a spectrum between BEGIN IONS and END IONS
+
+    Returns
+    -------
+    tuple
+        header values by name and the position of the first peak line
+
+    """
+    header = dict()
+    position = 0
+
+    # header lines precede the peak lines
+    while position < len(block):
+        newline = block.find(b'\n', position)
+        if newline < 0:
+            newline = len(block)
+        line = block[position:newline].strip()
+
+        if line and b'=' not in line:
+            break
+
+        if line:
+            name, value = line.split(b'=', 1)
+            header[name] = value
+        position = newline + 1
+
+    return header, position
+
+
+def parse_spectrum_block(block, dtype=numpy.float64):
+    """ 
+    Parses the header and the peaks of a spectrum 
+    
+    Parameters
+    ----------
+    block : bytes
+        content of a spectrum between BEGIN IONS and END IONS
+    dtype : numpy.dtype
+        float type of the peak arrays
+
+    Returns
+    -------
+    Spectrum
+        parsed spectrum or None if title, pepmass or charge are missing
+
+    """
+    header, position = parse_spectrum_header(block)
+
+    if not (b'TITLE' in header and b'PEPMASS' in header and b'CHARGE' in header):
+        return None
+
+    title = header[b'TITLE'].decode('utf-8', 'replace')
+    pepmass = float(header[b'PEPMASS'].split()[0])
+    charge = re.match(rb'(\d)\+', header[b'CHARGE'])
+    charge = int(charge[1]) if charge else 0
+
+    mz, intensity = parse_peaks(block[position:])
+    sumI = sum(intensity.tolist())
+
+    return Spectrum(title, pepmass, charge,
+        mz.astype(dtype, copy=False), intensity.astype(dtype, copy=False), sumI)
+
+
+def iter_mgf(input_file, dtype=numpy.float64):
+    """ 
+    Streams the spectra of an MGF one at a time, memory is bounded by the largest spectrum 
+    
+    Parameters
+    ----------
+    input_file : str
+        path to a plain or gzip compressed mgf
+    dtype : numpy.dtype
+        float type of the peak arrays, float32 halves the memory of the peaks
+
+    Yields
+    ------
+    tuple
+        key of the spectrum (index=N) and the Spectrum
+
+    """
+    with open_file(input_file, 'rb') as mgf_file:
+        for spectrum_mgf_index, block in enumerate(iter_spectrum_blocks(mgf_file)):
+            spectrum = parse_spectrum_block(block, dtype)
+            if spectrum is not None:
+                yield 'index=' + str(spectrum_mgf_index), spectrum
+
+
+def parse_mgf(input_file, dtype=numpy.float64):
+    """ 
+    Parses all spectra of an MGF into a dictionary 
+    
+    Parameters
+    ----------
+    input_file : str
+        path to a plain or gzip compressed mgf
+    dtype : numpy.dtype
+        float type of the peak arrays
+
+    Returns
+    -------
+    tuple
+        entries in the mgf and tokens of the mgf
+
+    """
+
+    entries = dict(iter_mgf(input_file, dtype))
+
+    # tokens describe the line layout of the first spectrum
+    first_spectrum = []
+    with open_file(input_file, 'r') as mgf_file:
+        for line in mgf_file:
+            first_spectrum.append(line.rstrip('\n'))
+            if 'END IONS' in line:
+                break
+    tokens = get_mgf_tokens(first_spectrum) if first_spectrum and 'END IONS' in first_spectrum[-1] else dict()
 
     return entries, tokens
 
@@ -0,0 +1,357 @@
+import os
+import re
+import mmap
+import logging
+import numpy
+
+from utils import is_gzip_file
+from parsers.mgf_file import iter_mgf, iter_spectrum_spans, parse_spectrum_header, parse_spectrum_block
+from parsers.spectrum_store import SpectrumStore
+
+log = logging.getLogger('PrideData')
+
+# bump when the layout of the index changes, older indices are rebuilt
+INDEX_VERSION = 1
+
+INDEX_SUFFIX = '.idx.npz'
+
+# ways of reading the spectra of an mgf, see iter_selected_spectra
+SPECTRA_SOURCES = ('stream', 'index', 'store')
+
+
+def index_path(input_file):
+    """
+    Path of the offset index saved next to an MGF
+    """
+    return input_file + INDEX_SUFFIX
+
+
+def _file_signature(input_file):
+    stat = os.stat(input_file)
+    return numpy.array([INDEX_VERSION, stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+
+
+def _parse_scan(value):
+    scan = re.match(rb'\s*(\d+)', value) if value is not None else None
+    return int(scan[1]) if scan else -1
+
+
+class MGFIndex(object):
+    """
+    Byte offsets of the spectra of an MGF, addressed by spectrum index (index=N),
+    TITLE or scan number. Spectra are numbered like iter_mgf numbers them, offsets
+    point to the content between BEGIN IONS and END IONS.
+    """
+
+    def __init__(self, begins, ends, titles, scans, signature):
+        self.begins = begins
+        self.ends = ends
+        self.titles = titles
+        self.scans = scans
+        self.signature = signature
+        self._by_title = None
+        self._by_scan = None
+
+    def __len__(self):
+        return len(self.begins)
+
+    @classmethod
+    def build(cls, input_file):
+        """
+        Builds the index of an uncompressed MGF in one pass.
+
+        Parameters
+        ----------
+        input_file: str
+            path to the mgf
+
+        Returns
+        -------
+        MGFIndex
+            offset index of the mgf
+
+        """
+        signature = _file_signature(input_file)
+        begins = []
+        ends = []
+        titles = []
+        scans = []
+
+        with open(input_file, 'rb') as mgf_file:
+            for begin, block in iter_spectrum_spans(mgf_file):
+                header, _ = parse_spectrum_header(block)
+                begins.append(begin)
+                ends.append(begin + len(block))
+                titles.append(header.get(b'TITLE', b''))
+                scans.append(_parse_scan(header.get(b'SCANS')))
+
+        return cls(numpy.array(begins, dtype=numpy.int64), numpy.array(ends, dtype=numpy.int64),
+                   numpy.array(titles, dtype=numpy.bytes_), numpy.array(scans, dtype=numpy.int64), signature)
+
+    @classmethod
+    def load(cls, input_file):
+        """
+        Loads the saved index of an MGF.
+
+        Returns
+        -------
+        MGFIndex
+            offset index or None if there is no index or the mgf changed since
+
+        """
+        path = index_path(input_file)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with numpy.load(path, allow_pickle=False) as data:
+                index = cls(data['begins'], data['ends'], data['titles'], data['scans'], data['signature'])
+        except (OSError, ValueError, KeyError):
+            log.warning("Unreadable MGF index {}, rebuilding!".format(path))
+            return None
+
+        if not numpy.array_equal(index.signature, _file_signature(input_file)):
+            return None
+        return index
+
+    def save(self, input_file):
+        """
+        Saves the index next to the MGF, the index is only kept in memory if the folder is not writable.
+        """
+        path = index_path(input_file)
+        # processes indexing the same mgf do not share a temporary file
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        try:
+            with open(temporary, 'wb') as fp:
+                numpy.savez(fp, begins=self.begins, ends=self.ends, titles=self.titles,
+                            scans=self.scans, signature=self.signature)
+            os.replace(temporary, path)
+        except OSError as e:
+            log.warning("MGF index {} not saved: {}".format(path, e))
+
+    @classmethod
+    def open(cls, input_file):
+        """
+        Loads the saved index of an MGF or builds and saves it.
+
+        Parameters
+        ----------
+        input_file: str
+            path to the uncompressed mgf
+
+        Returns
+        -------
+        MGFIndex
+            offset index of the mgf
+
+        """
+        index = cls.load(input_file)
+        if index is None:
+            log.info("Indexing MGF {}".format(input_file))
+            index = cls.build(input_file)
+            index.save(input_file)
+        return index
+
+    def position(self, key):
+        """
+        Resolves a spectrum index key (index=N) to the position of the spectrum.
+
+        Returns
+        -------
+        int
+            position in the index or None if the key does not address a spectrum
+
+        """
+        if not key.startswith('index='):
+            return None
+        try:
+            position = int(key[6:])
+        except ValueError:
+            return None
+        return position if 0 <= position < len(self.begins) else None
+
+    def position_by_title(self, title):
+        """
+        Returns the position of the first spectrum with a TITLE or None.
+        """
+        if self._by_title is None:
+            self._by_title = dict()
+            for position, value in enumerate(self.titles.tolist()):
+                self._by_title.setdefault(value.decode('utf-8', 'replace'), position)
+        return self._by_title.get(title)
+
+    def position_by_scan(self, scan):
+        """
+        Returns the position of the first spectrum with a scan number (SCANS) or None.
+        """
+        if self._by_scan is None:
+            self._by_scan = dict()
+            for position, value in enumerate(self.scans.tolist()):
+                if value >= 0:
+                    self._by_scan.setdefault(value, position)
+        return self._by_scan.get(scan)
+
+
+class IndexedMGF(object):
+    """
+    Memory mapped MGF which parses single spectra on request using its offset index.
+    """
+
+    def __init__(self, input_file, dtype=numpy.float64):
+        self.input_file = input_file
+        self.dtype = dtype
+        self.index = MGFIndex.open(input_file)
+        self._file = open(input_file, 'rb')
+        # an empty file can not be mapped
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if len(self.index) else None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return self.index.position(key) is not None
+
+    def spectrum(self, position):
+        """
+        Parses the spectrum at a position of the index.
+
+        Returns
+        -------
+        Spectrum
+            parsed spectrum or None if title, pepmass or charge are missing
+
+        """
+        return parse_spectrum_block(self._map[self.index.begins[position]:self.index.ends[position]], self.dtype)
+
+    def get(self, key, default=None):
+        """
+        Returns the spectrum of an index key (index=N) or the default.
+        """
+        position = self.index.position(key)
+        spectrum = self.spectrum(position) if position is not None else None
+        return default if spectrum is None else spectrum
+
+    def get_by_title(self, title, default=None):
+        """
+        Returns the first spectrum with a TITLE or the default.
+        """
+        position = self.index.position_by_title(title)
+        spectrum = self.spectrum(position) if position is not None else None
+        return default if spectrum is None else spectrum
+
+    def get_by_scan(self, scan, default=None):
+        """
+        Returns the first spectrum with a scan number or the default.
+        """
+        position = self.index.position_by_scan(scan)
+        spectrum = self.spectrum(position) if position is not None else None
+        return default if spectrum is None else spectrum
+
+    def iter_spectra(self, keys):
+        """
+        Parses the spectra of index keys in file order.
+
+        Parameters
+        ----------
+        keys: iterable
+            spectrum index keys (index=N), unknown keys are skipped
+
+        Yields
+        ------
+        tuple
+            key and Spectrum
+
+        """
+        positions = []
+        for key in keys:
+            position = self.index.position(key)
+            if position is not None:
+                positions.append((position, key))
+
+        for position, key in sorted(positions):
+            spectrum = self.spectrum(position)
+            if spectrum is not None:
+                yield key, spectrum
+
+
+def iter_selected_spectra(input_file, keys, dtype=numpy.float64, source='index'):
+    """
+    Reads only the spectra of an MGF addressed by index keys (index=N), in file order.
+    With the index source uncompressed files are read through their offset index,
+    gzip compressed files can not be addressed and are streamed instead. The store
+    source converts the MGF once into a columnar spectrum store and reads the
+    spectra from it without parsing text.
+
+    Parameters
+    ----------
+    input_file : str
+        path to a plain or gzip compressed mgf
+    keys : collection
+        spectrum index keys, unknown keys are skipped
+    dtype : numpy.dtype
+        float type of the peak arrays, the store always holds float64 peaks
+    source : str
+        'stream', 'index' or 'store'
+
+    Yields
+    ------
+    tuple
+        key and Spectrum
+
+    """
+    if source not in SPECTRA_SOURCES:
+        raise ValueError("Unknown spectra source {}!".format(source))
+
+    if source == 'store':
+        yield from SpectrumStore.open(input_file).iter_spectra(keys)
+        return
+
+    if source == 'stream' or is_gzip_file(input_file):
+        for key, spectrum in iter_mgf(input_file, dtype):
+            if key in keys:
+                yield key, spectrum
+        return
+
+    with IndexedMGF(input_file, dtype) as mgf:
+        yield from mgf.iter_spectra(keys)
+
+
+def open_spectra(input_file, dtype=numpy.float64, source='index'):
+    """
+    Opens an MGF for random access to its spectra by index keys (index=N).
+
+    Parameters
+    ----------
+    input_file : str
+        path to a plain or gzip compressed mgf
+    dtype : numpy.dtype
+        float type of the peak arrays, the store always holds float64 peaks
+    source : str
+        'stream', 'index' or 'store'
+
+    Returns
+    -------
+    IndexedMGF or SpectrumStore
+        spectra addressable with get, None if the source only streams the mgf
+
+    """
+    if source not in SPECTRA_SOURCES:
+        raise ValueError("Unknown spectra source {}!".format(source))
+
+    if source == 'store':
+        return SpectrumStore.open(input_file)
+    if source == 'stream' or is_gzip_file(input_file):
+        return None
+    return IndexedMGF(input_file, dtype)
@@ -1,4 +1,13 @@
-import xml.sax
+import xml.parsers.expat
+
+from utils import open_file
+from parsers.psm_table import PSMTable, AMBIGUOUS_RESIDUES
+
+# bytes fed to the xml parser at once
+MZID_CHUNK_SIZE = 1024 * 1024
+
+# bump when the parsed psms change, cached results of older versions are not used
+PARSER_VERSION = 1
 
 class _Result(object):
     """Representation of a PSM"""
@@ -38,7 +47,7 @@ def make_result(result_spec_ident, result_pep_evid, result_seq, result_mod, resu
 
     _internal_result = None
 
-    if 'X' in result_seq or 'B' in result_seq or 'Z' in result_seq or 'J' in result_seq:
+    if not result_seq or any(residue in result_seq for residue in AMBIGUOUS_RESIDUES):
         return _internal_result
 
     if result_spec_ident and result_pep_evid and result_seq:
@@ -56,8 +65,8 @@ def make_result(result_spec_ident, result_pep_evid, result_seq, result_mod, resu
     return _internal_result
 
 
-class MZIdentMLHandler(xml.sax.handler.ContentHandler):
-    """Implements a SAX xml parser for mzids"""
+class MZIdentMLHandler(object):
+    """Implements an expat based xml parser for mzids"""
 
     def __init__(self):
         self._result_params = dict()
@@ -69,12 +78,22 @@ class MZIdentMLHandler(xml.sax.handler.ContentHandler):
         self._result_mod = dict()
         self._result_ident_params = dict()
 
-        self._peptide_ref = 0
-        self._sequence = 1
-
-        self._open_tags = list()
+        # number of open elements, nesting is tracked in constant time
+        self._in_modification = 0
+        self._in_fragment_tolerance = 0
+        self._in_spectrum_ident = 0
+        self._in_peptide_sequence = 0
 
         self._charBuffer = []
+        self._parser = None
+
+        # streaming state, identification items are kept until their result closes
+        self._streaming = False
+        self._current_item = None
+        self._result_items = list()
+        self._pending_items = list()
+        self._finished = list()
+        self.table = PSMTable()
 
         self._current_pep = str()
         self._current_spec_ident = str()
@@ -82,12 +101,12 @@ class MZIdentMLHandler(xml.sax.handler.ContentHandler):
 
     def parse(self, f):
         """ 
-        SAX parser for mzid extracting psm information. 
+        Expat parser for mzid extracting psm information. 
         
         Parameters
         ----------
         f: path
-            MZID path
+            path to a plain or gzip compressed MZID or a readable file
         
         Returns
         -------
@@ -95,8 +114,8 @@ class MZIdentMLHandler(xml.sax.handler.ContentHandler):
             psm result
         
         """
-        
-        xml.sax.parse(f, self)
+        for _ in self._feed(f):
+            pass
 
         results = dict()
 
@@ -106,91 +125,233 @@ class MZIdentMLHandler(xml.sax.handler.ContentHandler):
                 self._result_pep_evid[peptide] if peptide in self._result_pep_evid else None, 
                 self._result_pep_seq[peptide] if peptide in self._result_pep_seq else None, 
                 self._result_mod[peptide] if peptide in self._result_mod else None,
-                self._result_ident_params[peptide] if peptide in self._result_ident_params else None)
+                self._result_ident_params[peptide] if peptide in self._result_ident_params else [])
 
             if result:
                 results[self._result_spec_ident[peptide][0]] = result
         
         return results, self._result_params
 
+    def iter_results(self, f):
+        """ 
+        Streams the psms of an mzid. Each identification item is yielded as soon
+        as its SpectrumIdentificationResult closes, items referencing peptides
+        which are listed later in the file are yielded at the end. Unlike parse
+        every item becomes a psm. The psms are rows of the PSMTable table, the
+        search parameters are available through parameters once the first psm
+        is yielded.
+        
+        Parameters
+        ----------
+        f: path
+            path to a plain or gzip compressed MZID or a readable file
+        
+        Yields
+        ------
+        tuple
+            spectrum id and PSMRow
+        
+        """
+        self._streaming = True
+
+        for _ in self._feed(f):
+            yield from self._finished
+            self._finished = list()
+
+        # identifications preceding their peptides
+        for item in self._pending_items:
+            row = self._append_item(item)
+            if row is not None:
+                yield item[1][0], self.table[row]
+        self._pending_items = list()
+
+    @property
+    def parameters(self):
+        """
+        Search parameters of the mzid parsed so far
+        """
+        return self._result_params
+
+    def parse_head(self, data):
+        """ 
+        Parses the beginning of an mzid up to its first identification list,
+        the sequence collection and the search parameters are kept.
+        
+        Parameters
+        ----------
+        data: bytes
+            beginning of an mzid
+        
+        """
+        self._streaming = True
+        self._create_parser().Parse(data, False)
+
+    def sequence_collection(self):
+        """ 
+        Returns the peptides, peptide evidences and search parameters parsed so far.
+        
+        Returns
+        -------
+        dict
+            lookups used to build psms, see set_sequence_collection
+        
+        """
+        return {'sequences': self._result_pep_seq, 'modifications': self._result_mod,
+                'evidences': self._result_pep_evid, 'parameters': self._result_params}
+
+    def set_sequence_collection(self, collection):
+        """ 
+        Uses the peptides, peptide evidences and search parameters of another
+        handler, e.g. to parse a part of the identification list.
+        
+        Parameters
+        ----------
+        collection: dict
+            lookups returned by sequence_collection
+        
+        """
+        self._result_pep_seq = collection['sequences']
+        self._result_mod = collection['modifications']
+        self._result_pep_evid = collection['evidences']
+        self._result_params = dict(collection['parameters'])
+
+    def _create_parser(self):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.buffer_text = True
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+        self._parser = parser
+        return parser
+
+    def _feed(self, f):
+        parser = self._create_parser()
+
+        if isinstance(f, str):
+            with open_file(f, 'rb') as fp:
+                yield from self._feed_file(parser, fp)
+        else:
+            yield from self._feed_file(parser, f)
+
+    @staticmethod
+    def _feed_file(parser, fp):
+        # files opened in text or binary mode are both accepted
+        while True:
+            data = fp.read(MZID_CHUNK_SIZE)
+            if not data:
+                break
+            parser.Parse(data, False)
+            yield
+        parser.Parse(b'', True)
+        yield
+
+    def _append_item(self, item):
+        peptide, spec_ident, params = item
+        return self.table.append(spec_ident[0], spec_ident[1], spec_ident[2], spec_ident[3],
+            self._result_pep_evid.get(peptide), self._result_pep_seq.get(peptide), self._result_mod.get(peptide), params)
+
+    def _finish_result_items(self):
+        for item in self._result_items:
+            if item[0] in self._result_pep_seq and item[0] in self._result_pep_evid:
+                row = self._append_item(item)
+                if row is not None:
+                    self._finished.append((item[1][0], self.table[row]))
+            else:
+                self._pending_items.append(item)
+        self._result_items = list()
+
     def _getCharacterData(self):
         data = ''.join(self._charBuffer).strip()
         self._charBuffer = []
-        return data.strip()  # remove strip() if whitespace is important
+        return data
 
     def startElement(self, name, attrs):
-        self._open_tags.append(name)
+        if name == 'cvParam':
+            if self._in_modification:
+                pass
+
+            elif self._in_fragment_tolerance:
+                if "search tolerance plus value" in attrs.get("name", '') and "dalton" in attrs.get("unitName", ''):
+                    self._result_params['search tolerance plus value'] = float(attrs['value'])
+                elif "search tolerance minus value" in attrs.get("name", '') and "dalton" in attrs.get("unitName", ''):
+                    self._result_params['search tolerance minus value'] = float(attrs['value'])
+
+            elif self._in_spectrum_ident:
+                if 'value' in attrs:
+                    if self._streaming:
+                        self._current_item[2].append((attrs['name'], attrs['value']))
+                    elif self._current_spec_ident in self._result_ident_params:
+                        self._result_ident_params[self._current_spec_ident].append((attrs['name'], attrs['value']))
+                    else:
+                        self._result_ident_params[self._current_spec_ident] = [(attrs['name'], attrs['value'])]
 
-        if name == 'AnalysisSoftware':
-            if 'name' in attrs.getNames():
-                self._result_params['AnalysisSoftware'] = attrs.getValue('name')
+        elif name == 'SpectrumIdentificationItem':
+            self._in_spectrum_ident += 1
+            self._current_spec_ident = attrs['peptide_ref']
+            spec_ident = (self._current_spec_id, attrs['rank'],
+                attrs['experimentalMassToCharge'], attrs['calculatedMassToCharge'])
+            if self._streaming:
+                self._current_item = (self._current_spec_ident, spec_ident, [])
             else:
-                self._result_params['AnalysisSoftware'] = attrs.getValue('id')
-
-        elif name == 'cvParam':
-            if 'Modification' in self._open_tags:
-                if self._current_pep in self._result_mod:
-                    self._result_mod[self._current_pep][-1] + \
-                        (attrs.getValue('name'),)
-
-            elif 'FragmentTolerance' in self._open_tags:
-                if "search tolerance plus value" in attrs.getValue("name") and "dalton" in attrs.getValue("unitName"):
-                    self._result_params['search tolerance plus value'] = float(
-                        attrs.getValue('value'))
-                elif "search tolerance minus value" in attrs.getValue("name") and "dalton" in attrs.getValue("unitName"):
-                    self._result_params['search tolerance minus value'] = float(
-                        attrs.getValue('value'))
-
-            elif "SpectrumIdentificationItem" in self._open_tags:
-                if 'value' in attrs.getNames():
-                    if self._current_spec_ident in self._result_ident_params:
-                        #print(self._current_spec_ident, (attrs.getValue('name'), attrs.getValue('value')))
-                        self._result_ident_params[self._current_spec_ident].append((attrs.getValue('name'), attrs.getValue('value')))
-                    else:
-                        self._result_ident_params[self._current_spec_ident] = list()
-                        #print(self._current_spec_ident, (attrs.getValue('name'), attrs.getValue('value')))
-                        self._result_ident_params[self._current_spec_ident].append((attrs.getValue('name'), attrs.getValue('value')))
+                self._result_spec_ident[self._current_spec_ident] = spec_ident
+
+        elif name == 'PeptideSequence':
+            self._in_peptide_sequence += 1
+            # text is only collected within peptide sequences
+            self._parser.CharacterDataHandler = self.characters
+
+        elif name == 'Peptide':
+            self._current_pep = attrs['id']
+            self._result_pep.append(self._current_pep)
+
+        elif name == 'PeptideEvidence':
+            if 'isDecoy' in attrs:
+                self._result_pep_evid[attrs['peptide_ref']] = attrs['isDecoy']
 
         elif name == 'Modification':
+            self._in_modification += 1
             if self._current_pep in self._result_mod:
                 self._result_mod[self._current_pep].append(
-                    (attrs.getValue('monoisotopicMassDelta'), attrs.getValue('location')))
+                    (attrs['monoisotopicMassDelta'], attrs['location']))
             else:
-                self._result_mod[self._current_pep] = list()
-                self._result_mod[self._current_pep].append(
-                    (attrs.getValue('monoisotopicMassDelta'), attrs.getValue('location')))
-
-        elif name == 'userParam':
-            if 'fragment_ion_tolerance' in attrs.getValue('name') and "dalton" in attrs.getValue("unitName"):
-                self._result_params['search tolerance plus value'] = float(
-                        attrs.getValue('value'))
-                self._result_params['search tolerance minus value'] = float(
-                        attrs.getValue('value'))
-
-        elif name == 'SpectrumIdentificationItem':
-            self._current_spec_ident = attrs.getValue('peptide_ref')
-            self._result_spec_ident[attrs.getValue('peptide_ref')] = (self._current_spec_id, attrs.getValue(
-                'rank'), attrs.getValue('experimentalMassToCharge'),  attrs.getValue('calculatedMassToCharge'))
+                self._result_mod[self._current_pep] = [(attrs['monoisotopicMassDelta'], attrs['location'])]
 
         elif name == 'SpectrumIdentificationResult':
-            self._current_spec_id = attrs.getValue('spectrumID').split()[0]
+            self._current_spec_id = attrs['spectrumID'].split()[0]
 
-        elif name == 'Peptide':
-            self._current_pep = attrs.getValue('id')
-            self._result_pep.append(self._current_pep)
+        elif name == 'userParam':
+            if 'fragment_ion_tolerance' in attrs.get('name', '') and "dalton" in attrs.get("unitName", ''):
+                self._result_params['search tolerance plus value'] = float(attrs['value'])
+                self._result_params['search tolerance minus value'] = float(attrs['value'])
 
-        elif name == 'PeptideEvidence':
-            if 'isDecoy' in attrs.getNames():
-                self._result_pep_evid[attrs.getValue('peptide_ref')] = attrs.getValue('isDecoy')
+        elif name == 'FragmentTolerance':
+            self._in_fragment_tolerance += 1
+
+        elif name == 'AnalysisSoftware':
+            if 'name' in attrs:
+                self._result_params['AnalysisSoftware'] = attrs['name']
+            else:
+                self._result_params['AnalysisSoftware'] = attrs['id']
 
     def endElement(self, name):
-        if name == 'PeptideSequence':
+        if name == 'SpectrumIdentificationItem':
+            self._in_spectrum_ident -= 1
+            if self._streaming:
+                self._result_items.append(self._current_item)
+        elif name == 'SpectrumIdentificationResult':
+            if self._streaming:
+                self._finish_result_items()
+        elif name == 'PeptideSequence':
+            self._in_peptide_sequence -= 1
+            if not self._in_peptide_sequence:
+                self._parser.CharacterDataHandler = None
             self._result_pep_seq[self._current_pep] = self._getCharacterData()
-
-        self._open_tags.remove(name)
+        elif name == 'Modification':
+            self._in_modification -= 1
+        elif name == 'FragmentTolerance':
+            self._in_fragment_tolerance -= 1
 
     def characters(self, data):
-        if 'PeptideSequence' in self._open_tags:
+        if self._in_peptide_sequence:
             self._charBuffer.append(data)
 
 
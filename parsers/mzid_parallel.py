@@ -0,0 +1,165 @@
+import io
+import os
+import mmap
+import logging
+from multiprocessing import Pool
+
+from utils import is_gzip_file
+from parsers.mzid_handler import MZIdentMLHandler
+
+log = logging.getLogger('PrideData')
+
+# smallest part of an identification list parsed by one process
+MIN_CHUNK_SIZE = 8 * 1024 * 1024
+
+# parts per process, smaller parts balance uneven results
+CHUNKS_PER_PROCESS = 4
+
+_LIST_START = b'<SpectrumIdentificationList'
+_LIST_END = b'</SpectrumIdentificationList>'
+_RESULT_START = b'<SpectrumIdentificationResult'
+
+# state of a chunk parsing process, set once by the pool initializer
+_worker_state = dict()
+
+
+def _find_tag(data, tag, start, end):
+    # the tag name has to end, e.g. <SpectrumIdentificationList but not <SpectrumIdentificationListX
+    while True:
+        position = data.find(tag, start, end)
+        if position < 0 or data[position + len(tag):position + len(tag) + 1] in (b' ', b'>', b'\n', b'\r', b'\t', b'/'):
+            return position
+        start = position + 1
+
+
+def scan_chunks(data, chunk_size):
+    """
+    Pre-scans an mzid for the identification lists and splits them between
+    SpectrumIdentificationResult elements.
+
+    Parameters
+    ----------
+    data: mmap.mmap
+        content of the mzid
+    chunk_size: int
+        aimed size of a chunk in bytes
+
+    Returns
+    -------
+    tuple
+        offset of the first identification list and (begin, end) byte ranges
+        of the chunks, (None, []) if the mzid has no identification list
+
+    """
+    chunks = []
+    head_end = None
+    position = 0
+
+    while True:
+        list_start = _find_tag(data, _LIST_START, position, len(data))
+        if list_start < 0:
+            break
+        list_end = data.find(_LIST_END, list_start)
+        if list_end < 0:
+            break
+        if head_end is None:
+            head_end = list_start
+
+        begin = data.find(b'>', list_start) + 1
+        while begin < list_end:
+            split = _find_tag(data, _RESULT_START, min(begin + chunk_size, list_end), list_end)
+            end = split if split >= 0 else list_end
+            chunks.append((begin, end))
+            begin = end
+        position = list_end + len(_LIST_END)
+
+    return head_end, chunks
+
+
+def _init_worker(path, declaration, collection):
+    _worker_state['path'] = path
+    _worker_state['declaration'] = declaration
+    _worker_state['collection'] = collection
+
+
+def _parse_chunk(chunk):
+    begin, end = chunk
+    with open(_worker_state['path'], 'rb') as fp:
+        fp.seek(begin)
+        data = fp.read(end - begin)
+
+    handler = MZIdentMLHandler()
+    handler.set_sequence_collection(_worker_state['collection'])
+    document = _worker_state['declaration'] + _LIST_START + b'>' + data + _LIST_END
+    for _ in handler.iter_results(io.BytesIO(document)):
+        pass
+    return handler.table
+
+
+def parse_sequential(path):
+    """
+    Parses all psms of an mzid into a table in one process.
+
+    Returns
+    -------
+    tuple
+        PSMTable and search parameters
+
+    """
+    handler = MZIdentMLHandler()
+    for _ in handler.iter_results(path):
+        pass
+    return handler.table, handler.parameters
+
+
+def parse_parallel(path, processes, chunk_size=None):
+    """
+    Parses the psms of a large mzid with several processes. The part before the
+    identification lists, containing the sequence collection and the search
+    parameters, is parsed once and passed to every process, the identification
+    lists are split between results and parsed in parallel. Compressed mzids and
+    mzids listing peptides after the identifications are parsed sequentially.
+
+    Parameters
+    ----------
+    path: str
+        path to a plain or gzip compressed mzid
+    processes: int
+        number of processes
+    chunk_size: int
+        aimed size of a chunk in bytes, derived from the file size by default
+
+    Returns
+    -------
+    tuple
+        PSMTable in file order and search parameters
+
+    """
+    if processes <= 1 or is_gzip_file(path) or os.path.getsize(path) == 0:
+        return parse_sequential(path)
+
+    with open(path, 'rb') as fp, mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if chunk_size is None:
+            chunk_size = max(MIN_CHUNK_SIZE, len(data) // (processes * CHUNKS_PER_PROCESS))
+        head_end, chunks = scan_chunks(data, chunk_size)
+
+        if head_end is None or _find_tag(data, b'<SequenceCollection', head_end, len(data)) >= 0:
+            log.info("MZID {} can not be split, parsing sequentially".format(path))
+            return parse_sequential(path)
+
+        head = data[:head_end]
+
+    declaration = head[:head.find(b'?>') + 2] if head.startswith(b'<?xml') else b''
+
+    handler = MZIdentMLHandler()
+    handler.parse_head(head)
+    collection = handler.sequence_collection()
+
+    log.info("Parsing MZID {} in {} chunks with {} processes".format(path, len(chunks), processes))
+    with Pool(processes=processes, initializer=_init_worker, initargs=(path, declaration, collection)) as pool:
+        tables = pool.map(_parse_chunk, chunks)
+
+    table = handler.table
+    for chunk_table in tables:
+        table.extend(chunk_table)
+    return table, collection['parameters']
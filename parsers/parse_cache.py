@@ -0,0 +1,184 @@
+import os
+import pickle
+import time
+import shutil
+import hashlib
+import logging
+
+from parsers.spectrum_store import SpectrumStore, STORE_VERSION
+
+log = logging.getLogger('PrideData')
+
+# bytes hashed at the beginning and the end of a file for its key
+SAMPLE_SIZE = 64 * 1024
+
+# seconds an entry is not evicted after its last use, other processes may be loading it
+EVICTION_GRACE = 300
+
+
+def content_key(path, kind, version):
+    """
+    Content key of a parsed file. Size, mtime and the first and last bytes of
+    the file identify its content, the kind and version identify the parser.
+
+    Parameters
+    ----------
+    path: str
+        path to the parsed file
+    kind: str
+        kind of the parsed output, e.g. psm_table
+    version: int
+        version of the parser
+
+    Returns
+    -------
+    str
+        hex digest
+
+    """
+    stat = os.stat(path)
+    digest = hashlib.sha1('{}:{}:{}:{}'.format(kind, version, stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    with open(path, 'rb') as fp:
+        digest.update(fp.read(SAMPLE_SIZE))
+        if stat.st_size > SAMPLE_SIZE:
+            fp.seek(max(stat.st_size - SAMPLE_SIZE, SAMPLE_SIZE))
+            digest.update(fp.read())
+    return digest.hexdigest()
+
+
+def _entry_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+    return os.path.getsize(path)
+
+
+class ParseCache(object):
+    """
+    Content addressed cache of parsed mzids and MGFs on disk. Parsed outputs
+    are pickled, spectra are kept as spectrum stores. The least recently used
+    entries are evicted once the cache exceeds its size.
+    """
+
+    def __init__(self, folder, max_size=4 * 1024 * 1024 * 1024):
+        self.folder = folder
+        self.max_size = max_size
+
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+    def get(self, kind, path, parse, version):
+        """
+        Returns the parsed output of a file from the cache or parses and caches it.
+
+        Parameters
+        ----------
+        kind: str
+            kind of the parsed output, e.g. psm_table
+        path: str
+            path to the parsed file
+        parse: function
+            parses the file, called with its path
+        version: int
+            version of the parser, outputs of other versions are not used
+
+        Returns
+        -------
+        object
+            parsed output
+
+        """
+        entry = os.path.join(self.folder, content_key(path, kind, version) + '.pickle')
+
+        try:
+            with open(entry, 'rb') as fp:
+                result = pickle.load(fp)
+            self._touch(entry)
+            log.info("Using cached {} of {}".format(kind, path))
+            return result
+        except FileNotFoundError:
+            pass
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError) as e:
+            log.warning("Unreadable cache entry {}: {}".format(entry, e))
+
+        result = parse(path)
+
+        temporary = '{}.{}.tmp'.format(entry, os.getpid())
+        with open(temporary, 'wb') as fp:
+            pickle.dump(result, fp, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary, entry)
+        self.evict(keep=entry)
+        return result
+
+    def spectra(self, path):
+        """
+        Returns the spectrum store of an MGF kept in the cache, the MGF is converted if it is not cached.
+
+        Parameters
+        ----------
+        path: str
+            path to a plain or gzip compressed mgf
+
+        Returns
+        -------
+        SpectrumStore
+            memory mapped store
+
+        """
+        entry = os.path.join(self.folder, content_key(path, 'spectra', STORE_VERSION) + '.store')
+        # touched before it is opened, evictions by other processes spare it
+        self._touch(entry)
+        cached = SpectrumStore.is_current(path, entry)
+        try:
+            store = SpectrumStore.open(path, entry)
+        except (OSError, ValueError) as e:
+            log.warning("Spectrum store {} changed while it was opened, converting again: {}".format(entry, e))
+            cached = False
+            store = SpectrumStore.convert(path, entry)
+        if not cached:
+            self.evict(keep=entry)
+        return store
+
+    def evict(self, keep=None):
+        """
+        Removes least recently used entries until the cache fits its size.
+        Entries used within EVICTION_GRACE seconds are kept.
+
+        Parameters
+        ----------
+        keep: str
+            entry which is not removed, e.g. the entry just written
+
+        """
+        entries = []
+        total = 0
+        recent = time.time() - EVICTION_GRACE
+        for name in os.listdir(self.folder):
+            if not (name.endswith('.pickle') or name.endswith('.store')):
+                continue
+            path = os.path.join(self.folder, name)
+            try:
+                size = _entry_size(path)
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+            total += size
+
+        for mtime, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if path == keep or mtime > recent:
+                continue
+            try:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+            except OSError:
+                continue
+            total -= size
@@ -0,0 +1,259 @@
+import math
+import array
+import numpy
+
+# score parameters of the identification items kept as numeric columns
+SCORE_COLUMNS = {
+    'Mascot:score': 'mascot_score',
+    'Mascot:identity threshold': 'mascot_threshold',
+    'Scaffold:Peptide Probability': 'scaffold_probability',
+}
+
+# the last value of these parameters is kept, the first for the others
+_LAST_VALUE_SCORES = ('mascot_score', 'mascot_threshold')
+
+# residues the features can not be calculated for
+AMBIGUOUS_RESIDUES = ('X', 'B', 'Z', 'J')
+
+
+def _score_value(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class PSMTable(object):
+    """
+    Struct-of-arrays table of PSMs. Ranks, masses, decoy flags and scores are
+    typed columns, sequences are interned and modifications are stored as a
+    compressed sparse row array. Rows are appended while an mzid is parsed,
+    PSMRow views read single rows and columns returns numpy copies.
+    """
+
+    def __init__(self):
+        self.spectrum_ids = list()
+        self.rank = array.array('i')
+        self.experimental_mz = array.array('d')
+        self.calculated_mz = array.array('d')
+        self.is_decoy = array.array('b')
+        self.sequence_ids = array.array('i')
+
+        # modifications of row i are mod_offsets[i]:mod_offsets[i + 1]
+        self.mod_offsets = array.array('q', [0])
+        self.mod_masses = array.array('d')
+        self.mod_locations = array.array('i')
+
+        self.scores = {column: array.array('d') for column in SCORE_COLUMNS.values()}
+
+        self.sequences = list()
+        self._sequence_ids = dict()
+
+    def __len__(self):
+        return len(self.rank)
+
+    def __getitem__(self, row):
+        if not 0 <= row < len(self.rank):
+            raise IndexError(row)
+        return PSMRow(self, row)
+
+    def __iter__(self):
+        for row in range(len(self.rank)):
+            yield PSMRow(self, row)
+
+    def append(self, spectrum_id, rank, experimental_mz, calculated_mz, is_decoy, sequence, modifications, parameters):
+        """
+        Appends a PSM, PSMs without decoy flag or sequence and sequences with
+        ambiguous residues are rejected like make_result rejects them.
+
+        Parameters
+        ----------
+        spectrum_id: str
+            id of the identified spectrum
+        rank: str
+            rank of the identification
+        experimental_mz: str
+            experimental mass to charge
+        calculated_mz: str
+            calculated mass to charge
+        is_decoy: str
+            isDecoy attribute of the peptide evidence
+        sequence: str
+            peptide sequence
+        modifications: list
+            (monoisotopicMassDelta, location) of the peptide
+        parameters: list
+            (name, value) parameters of the identification item
+
+        Returns
+        -------
+        int
+            row of the PSM or None if it was rejected
+
+        """
+        if not (is_decoy and sequence) or any(residue in sequence for residue in AMBIGUOUS_RESIDUES):
+            return None
+
+        row = len(self.rank)
+        self.spectrum_ids.append(spectrum_id)
+        self.rank.append(int(rank))
+        self.experimental_mz.append(float(experimental_mz))
+        self.calculated_mz.append(float(calculated_mz))
+        self.is_decoy.append(is_decoy == 'true')
+
+        self.sequence_ids.append(self._intern(sequence))
+
+        if modifications:
+            for mass, location in modifications:
+                self.mod_masses.append(float(mass))
+                self.mod_locations.append(int(location))
+        self.mod_offsets.append(len(self.mod_masses))
+
+        scores = dict()
+        for name, value in parameters:
+            column = SCORE_COLUMNS.get(name)
+            if column is not None and (column in _LAST_VALUE_SCORES or column not in scores):
+                scores[column] = value
+        for column, values in self.scores.items():
+            values.append(_score_value(scores.get(column)))
+
+        return row
+
+    def _intern(self, sequence):
+        sequence_id = self._sequence_ids.get(sequence)
+        if sequence_id is None:
+            sequence_id = self._sequence_ids[sequence] = len(self.sequences)
+            self.sequences.append(sequence)
+        return sequence_id
+
+    def extend(self, other):
+        """
+        Appends the rows of another table.
+
+        Parameters
+        ----------
+        other: PSMTable
+            table whose rows are appended in order
+
+        """
+        sequence_ids = [self._intern(sequence) for sequence in other.sequences]
+        mod_offset = len(self.mod_masses)
+
+        self.spectrum_ids.extend(other.spectrum_ids)
+        self.rank.extend(other.rank)
+        self.experimental_mz.extend(other.experimental_mz)
+        self.calculated_mz.extend(other.calculated_mz)
+        self.is_decoy.extend(other.is_decoy)
+        self.sequence_ids.extend(sequence_ids[sequence_id] for sequence_id in other.sequence_ids)
+        self.mod_offsets.extend(offset + mod_offset for offset in other.mod_offsets[1:])
+        self.mod_masses.extend(other.mod_masses)
+        self.mod_locations.extend(other.mod_locations)
+        for column, values in self.scores.items():
+            values.extend(other.scores[column])
+
+    def slice(self, begin, end):
+        """
+        Copies a range of rows into a new table.
+
+        Parameters
+        ----------
+        begin: int
+            first row
+        end: int
+            row after the last row
+
+        Returns
+        -------
+        PSMTable
+            table of the rows
+
+        """
+        table = PSMTable()
+        mod_begin, mod_end = self.mod_offsets[begin], self.mod_offsets[end]
+
+        table.spectrum_ids = self.spectrum_ids[begin:end]
+        table.rank = self.rank[begin:end]
+        table.experimental_mz = self.experimental_mz[begin:end]
+        table.calculated_mz = self.calculated_mz[begin:end]
+        table.is_decoy = self.is_decoy[begin:end]
+        table.sequence_ids = array.array('i', (table._intern(self.sequences[sequence_id])
+                                               for sequence_id in self.sequence_ids[begin:end]))
+        table.mod_offsets = array.array('q', (offset - mod_begin for offset in self.mod_offsets[begin:end + 1]))
+        table.mod_masses = self.mod_masses[mod_begin:mod_end]
+        table.mod_locations = self.mod_locations[mod_begin:mod_end]
+        table.scores = {column: values[begin:end] for column, values in self.scores.items()}
+        return table
+
+    def columns(self):
+        """
+        Returns the columns of the table as numpy arrays.
+
+        Returns
+        -------
+        dict
+            arrays by column name, sequences are given by sequence_ids into sequences
+
+        """
+        columns = {
+            'rank': numpy.array(self.rank, dtype=numpy.int32),
+            'experimental_mz': numpy.array(self.experimental_mz, dtype=numpy.float64),
+            'calculated_mz': numpy.array(self.calculated_mz, dtype=numpy.float64),
+            'is_decoy': numpy.array(self.is_decoy, dtype=numpy.bool_),
+            'sequence_ids': numpy.array(self.sequence_ids, dtype=numpy.int32),
+            'mod_offsets': numpy.array(self.mod_offsets, dtype=numpy.int64),
+            'mod_masses': numpy.array(self.mod_masses, dtype=numpy.float64),
+            'mod_locations': numpy.array(self.mod_locations, dtype=numpy.int32),
+        }
+        for column, values in self.scores.items():
+            columns[column] = numpy.array(values, dtype=numpy.float64)
+        return columns
+
+
+class PSMRow(object):
+    """
+    View of a row of a PSMTable with the attributes of a _Result
+    """
+
+    __slots__ = ('table', 'row')
+
+    def __init__(self, table, row):
+        self.table = table
+        self.row = row
+
+    @property
+    def spectrum_id(self):
+        return self.table.spectrum_ids[self.row]
+
+    @property
+    def rank(self):
+        return self.table.rank[self.row]
+
+    @property
+    def experimentalMassToCharge(self):
+        return self.table.experimental_mz[self.row]
+
+    @property
+    def calculatedMassToCharge(self):
+        return self.table.calculated_mz[self.row]
+
+    @property
+    def isDecoy(self):
+        return bool(self.table.is_decoy[self.row])
+
+    @property
+    def sequence(self):
+        return self.table.sequences[self.table.sequence_ids[self.row]]
+
+    @property
+    def modifications(self):
+        begin, end = self.table.mod_offsets[self.row], self.table.mod_offsets[self.row + 1]
+        return list(zip(self.table.mod_masses[begin:end], self.table.mod_locations[begin:end]))
+
+    def score(self, column):
+        """
+        Returns a score column of the row, NaN if the identification has no such score.
+        """
+        return self.table.scores[column][self.row]
+
+    def __repr__(self):
+        return 'PSMRow(spectrum_id={!r}, rank={!r}, sequence={!r})'.format(self.spectrum_id, self.rank, self.sequence)
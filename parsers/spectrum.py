@@ -0,0 +1,97 @@
+import numpy
+
+
+class Spectrum(object):
+    """
+    Spectrum of an MGF with contiguous peak arrays sorted by m/z. A spectrum is
+    prepared once and shared by all PSMs identifying it, the intensity statistics
+    of the features are calculated on first use and kept.
+    """
+
+    __slots__ = ('title', 'pepmass', 'charge', 'mz', 'intensity', 'sumI', '_statistics')
+
+    def __init__(self, title, pepmass, charge, mz, intensity, sumI=None, is_sorted=False):
+        """
+        Parameters
+        ----------
+        title: str
+            title of the spectrum
+        pepmass: float
+            precursor m/z
+        charge: int
+            precursor charge
+        mz: numpy.ndarray
+            m/z values of the peaks
+        intensity: numpy.ndarray
+            intensities of the peaks
+        sumI: float
+            sum of the intensities in file order, calculated with the builtin sum if not given
+        is_sorted: bool
+            skips sorting peaks which are known to be sorted by m/z
+        """
+        self.title = title
+        self.pepmass = pepmass
+        self.charge = charge
+        self.sumI = sum(intensity.tolist()) if sumI is None else sumI
+
+        if not is_sorted and len(mz) > 1 and not numpy.all(mz[1:] >= mz[:-1]):
+            order = numpy.argsort(mz, kind='stable')
+            mz = mz[order]
+            intensity = intensity[order]
+
+        self.mz = mz
+        self.intensity = intensity
+        self._statistics = None
+
+    def __getitem__(self, key):
+        # dictionary access of the former spectrum representation
+        if key == 'mz_list':
+            return self.mz
+        if key == 'intensity_list':
+            return self.intensity
+        if key in self.__slots__ and not key.startswith('_'):
+            return getattr(self, key)
+        raise KeyError(key)
+
+    def statistics(self):
+        """
+        Returns the highest intensity and the sum of the intensities of the sorted peaks
+
+        Returns
+        -------
+        tuple
+            highest intensity, at least 0.0, and the sequential sum of the intensities
+        """
+        if self._statistics is None:
+            intensity = numpy.asarray(self.intensity, dtype=numpy.float64)
+            if len(intensity) == 0:
+                self._statistics = (0.0, 0.0)
+            else:
+                # a running float64 sum in peak order, NaN peaks are never the highest
+                self._statistics = (float(numpy.fmax.reduce(intensity, initial=0.0)),
+                                    float(numpy.cumsum(intensity)[-1]))
+        return self._statistics
+
+    @property
+    def highest_intensity(self):
+        return self.statistics()[0]
+
+    @property
+    def intensity_sum(self):
+        return self.statistics()[1]
+
+    def __repr__(self):
+        return 'Spectrum(title={!r}, pepmass={!r}, charge={!r}, peaks={})'.format(
+            self.title, self.pepmass, self.charge, len(self.mz))
+
+    def to_dict(self):
+        """
+        Converts the spectrum to a dictionary of python values
+
+        Returns
+        -------
+        dict
+            title, pepmass, charge and peak lists
+        """
+        return {'title': self.title, 'pepmass': self.pepmass, 'charge': self.charge,
+                'mz_list': self.mz.tolist(), 'intensity_list': self.intensity.tolist()}
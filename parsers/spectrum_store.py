@@ -0,0 +1,260 @@
+import os
+import struct
+import shutil
+import logging
+import numpy
+
+from parsers.mgf_file import iter_mgf
+from parsers.spectrum import Spectrum
+
+log = logging.getLogger('PrideData')
+
+# bump when the layout of the store changes, older stores are converted again
+STORE_VERSION = 1
+
+STORE_SUFFIX = '.store'
+
+# columns of a store, one .npy file each
+COLUMNS = ('mz', 'intensity', 'offsets', 'positions', 'pepmass', 'charge', 'sumI', 'titles', 'signature')
+
+# peak columns are appended while an mgf is converted
+PEAK_COLUMNS = ('mz', 'intensity')
+
+# bytes reserved for the .npy header of a peak column, written once its length is known
+_HEADER_SIZE = 128
+
+
+def store_path(input_file):
+    """
+    Path of the spectrum store converted from an MGF
+    """
+    return input_file + STORE_SUFFIX
+
+
+def _file_signature(input_file):
+    stat = os.stat(input_file)
+    return numpy.array([STORE_VERSION, stat.st_size, stat.st_mtime_ns], dtype=numpy.int64)
+
+
+def _npy_header(dtype, length):
+    # version 1.0 header of a one dimensional array padded to _HEADER_SIZE bytes
+    header = "{{'descr': {!r}, 'fortran_order': False, 'shape': ({},), }}".format(numpy.dtype(dtype).str, length)
+    header = header.ljust(_HEADER_SIZE - 11) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header.encode('latin1')
+
+
+class SpectrumStore(object):
+    """
+    Columnar binary copy of the spectra of an MGF. The peaks of all spectra are
+    kept in two flat arrays sorted by m/z per spectrum, offsets delimit the
+    spectra. The columns are memory mapped, spectra are views without copies.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        columns = dict()
+        for column in COLUMNS:
+            columns[column] = numpy.load(os.path.join(path, column + '.npy'), mmap_mode='r', allow_pickle=False)
+
+        self.mz = columns['mz']
+        self.intensity = columns['intensity']
+        self.offsets = columns['offsets']
+        self.positions = columns['positions']
+        self.pepmass = columns['pepmass']
+        self.charge = columns['charge']
+        self.sumI = columns['sumI']
+        self.titles = columns['titles']
+        self.signature = columns['signature']
+
+        # spectrum index (index=N) to row, spectra without title, pepmass or charge are not stored
+        self._rows = dict(zip(self.positions.tolist(), range(len(self.positions))))
+
+    @classmethod
+    def convert(cls, input_file, path=None):
+        """
+        Converts an MGF into a spectrum store.
+
+        Parameters
+        ----------
+        input_file: str
+            path to a plain or gzip compressed mgf
+        path: str
+            folder of the store, next to the mgf by default
+
+        Returns
+        -------
+        SpectrumStore
+            the converted store
+
+        """
+        path = path or store_path(input_file)
+        signature = _file_signature(input_file)
+        log.info("Converting MGF {} to spectrum store {}".format(input_file, path))
+
+        # written to a temporary folder, readers never see a partial store
+        temporary = '{}.{}.tmp'.format(path, os.getpid())
+        if os.path.exists(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+
+        offsets = [0]
+        positions = []
+        pepmass = []
+        charge = []
+        sumI = []
+        titles = []
+
+        # peaks are appended to their columns spectrum by spectrum instead of being held in memory
+        peaks = {column: open(os.path.join(temporary, column + '.npy'), 'wb') for column in PEAK_COLUMNS}
+        try:
+            for fp in peaks.values():
+                fp.seek(_HEADER_SIZE)
+
+            for key, spectrum in iter_mgf(input_file):
+                peaks['mz'].write(numpy.ascontiguousarray(spectrum.mz, dtype=numpy.float64).tobytes())
+                peaks['intensity'].write(numpy.ascontiguousarray(spectrum.intensity, dtype=numpy.float64).tobytes())
+                offsets.append(offsets[-1] + len(spectrum.mz))
+                positions.append(int(key[6:]))
+                pepmass.append(spectrum.pepmass)
+                charge.append(spectrum.charge)
+                sumI.append(spectrum.sumI)
+                titles.append(spectrum.title.encode('utf-8'))
+
+            for fp in peaks.values():
+                fp.seek(0)
+                fp.write(_npy_header(numpy.float64, offsets[-1]))
+        finally:
+            for fp in peaks.values():
+                fp.close()
+
+        columns = {
+            'offsets': numpy.array(offsets, dtype=numpy.int64),
+            'positions': numpy.array(positions, dtype=numpy.int64),
+            'pepmass': numpy.array(pepmass, dtype=numpy.float64),
+            'charge': numpy.array(charge, dtype=numpy.int64),
+            'sumI': numpy.array(sumI, dtype=numpy.float64),
+            'titles': numpy.array(titles, dtype=numpy.bytes_),
+            'signature': signature,
+        }
+        for column, values in columns.items():
+            numpy.save(os.path.join(temporary, column + '.npy'), values, allow_pickle=False)
+
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.replace(temporary, path)
+        return cls(path)
+
+    @classmethod
+    def is_current(cls, input_file, path=None):
+        """
+        Checks if the store of an MGF exists and was converted from its current version.
+        """
+        signature = os.path.join(path or store_path(input_file), 'signature.npy')
+        if not os.path.exists(signature):
+            return False
+        try:
+            return numpy.array_equal(numpy.load(signature, allow_pickle=False), _file_signature(input_file))
+        except (OSError, ValueError):
+            return False
+
+    @classmethod
+    def open(cls, input_file, path=None):
+        """
+        Opens the store of an MGF, the MGF is converted if there is no current store.
+
+        Parameters
+        ----------
+        input_file: str
+            path to a plain or gzip compressed mgf
+        path: str
+            folder of the store, next to the mgf by default
+
+        Returns
+        -------
+        SpectrumStore
+            memory mapped store
+
+        """
+        path = path or store_path(input_file)
+        if cls.is_current(input_file, path):
+            return cls(path)
+        return cls.convert(input_file, path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        # the maps are released with the last spectrum referencing them
+        self.mz = self.intensity = None
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, key):
+        return self._row(key) is not None
+
+    def __getitem__(self, key):
+        row = self._row(key)
+        if row is None:
+            raise KeyError(key)
+        return self.spectrum(row)
+
+    def __iter__(self):
+        for row in range(len(self.positions)):
+            yield 'index=' + str(self.positions[row]), self.spectrum(row)
+
+    def _row(self, key):
+        if not key.startswith('index='):
+            return None
+        try:
+            return self._rows.get(int(key[6:]))
+        except ValueError:
+            return None
+
+    def get(self, key, default=None):
+        """
+        Returns the spectrum of an index key (index=N) or the default.
+        """
+        row = self._row(key)
+        return default if row is None else self.spectrum(row)
+
+    def spectrum(self, row):
+        """
+        Returns the spectrum of a row, the peak arrays are views into the store.
+
+        Returns
+        -------
+        Spectrum
+            spectrum with peaks sorted by m/z
+
+        """
+        begin, end = self.offsets[row], self.offsets[row + 1]
+        return Spectrum(self.titles[row].decode('utf-8', 'replace'), float(self.pepmass[row]), int(self.charge[row]),
+                        self.mz[begin:end], self.intensity[begin:end], float(self.sumI[row]), is_sorted=True)
+
+    def iter_spectra(self, keys):
+        """
+        Returns the spectra of index keys in file order.
+
+        Parameters
+        ----------
+        keys: iterable
+            spectrum index keys (index=N), unknown keys are skipped
+
+        Yields
+        ------
+        tuple
+            key and Spectrum
+
+        """
+        rows = []
+        for key in keys:
+            row = self._row(key)
+            if row is not None:
+                rows.append((row, key))
+
+        for row, key in sorted(rows):
+            yield key, self.spectrum(row)
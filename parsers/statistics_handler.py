@@ -1,47 +1,198 @@
-import xml.sax
+import xml.parsers.expat
+
+from utils import open_file
+
+# bytes fed to the xml parser at once, the scan usually stops within the first chunks
+STAT_CHUNK_SIZE = 64 * 1024
+
+# peptides hold nothing of interest, their collection is skipped without parsing
+_COLLECTION_START = b'<SequenceCollection'
+_COLLECTION_END = b'</SequenceCollection>'
+
+
+class _ScanComplete(Exception):
+    """Raised by the handlers once everything of interest was read"""
+
+
+class StatisticsHandler(object):
+    """
+    Implements an expat based scanner for the head of mzids. Software,
+    fragment tolerances and the parameters of the first identification item
+    are read. mzIdentML lists software and protocols before the identifications,
+    the scan stops once the first SpectrumIdentificationItem and the
+    AnalysisProtocolCollection closed. The SequenceCollection is skipped.
+    """
 
-class StatisticsHandler(xml.sax.handler.ContentHandler):
     def __init__(self):
         self._result = dict()
+        self._result['score_params'] = []
+        self._in_fragment_tolerance = 0
         self._spectrum_identification_item = False
+        self._scanned_item = False
+        self._scanned_protocol = False
 
     def parse(self, f):
-        """ 
-        SAX parser for mzid extracting statistics about software and identification parameters. 
-        
+        """
+        Scans an mzid for statistics about software and identification parameters.
+
         Parameters
         ----------
         f: path
-            MZID path
-        
+            path to a plain or gzip compressed MZID or a readable file
+
         Returns
         -------
         dict
-            statistics result
-        
+            statistics result, software, params (last cvParam of the first
+            identification item), score_params (names of all its parameters) and
+            the search tolerance plus and minus values if given in dalton
+
         """
-        xml.sax.parse(f, self)
+        if isinstance(f, str):
+            with open_file(f, 'rb') as fp:
+                self._scan(fp)
+        else:
+            self._scan(f)
         return self._result
 
+    def _scan(self, fp):
+        parser = xml.parsers.expat.ParserCreate()
+        parser.StartElementHandler = self.startElement
+        parser.EndElementHandler = self.endElement
+
+        try:
+            for data in _skip_sequence_collection(fp):
+                parser.Parse(data, False)
+            parser.Parse(b'', True)
+        except _ScanComplete:
+            pass
+
+    def _complete(self):
+        if self._scanned_item and self._scanned_protocol and 'software' in self._result:
+            raise _ScanComplete()
+
     def startElement(self, name, attrs):
-        if name == "AnalysisSoftware":
-            if 'name' in attrs.getNames():
-                self._result['software'] = attrs.getValue('name')
+        if name == 'AnalysisSoftware':
+            if 'name' in attrs:
+                self._result['software'] = attrs['name']
             else:
-                self._result['software'] = attrs.getValue('id')
+                self._result['software'] = attrs['id']
 
         elif name == 'SpectrumIdentificationItem':
-            if 'params' not in self._result:
+            if not self._scanned_item:
                 self._spectrum_identification_item = True
 
-        elif self._spectrum_identification_item and name == 'cvParam':
-            self._result['params'] = attrs.getValue('name')
-    
+        elif name == 'cvParam':
+            if self._spectrum_identification_item:
+                self._result['params'] = attrs['name']
+                self._result['score_params'].append(attrs['name'])
+
+            elif self._in_fragment_tolerance and "dalton" in attrs.get("unitName", ''):
+                if "search tolerance plus value" in attrs.get("name", ''):
+                    self._result['search tolerance plus value'] = float(attrs['value'])
+                elif "search tolerance minus value" in attrs.get("name", ''):
+                    self._result['search tolerance minus value'] = float(attrs['value'])
+
+        elif name == 'userParam':
+            if self._spectrum_identification_item:
+                self._result['score_params'].append(attrs.get('name', ''))
+
+            if 'fragment_ion_tolerance' in attrs.get('name', '') and "dalton" in attrs.get("unitName", ''):
+                self._result['search tolerance plus value'] = float(attrs['value'])
+                self._result['search tolerance minus value'] = float(attrs['value'])
+
+        elif name == 'FragmentTolerance':
+            self._in_fragment_tolerance += 1
+
     def endElement(self, name):
-        if name == 'SpectrumIdentificationItem':
+        if name == 'SpectrumIdentificationItem' and self._spectrum_identification_item:
             self._spectrum_identification_item = False
+            self._scanned_item = True
+            self._complete()
+
+        elif name == 'AnalysisProtocolCollection':
+            self._scanned_protocol = True
+            self._complete()
+
+        elif name == 'FragmentTolerance':
+            self._in_fragment_tolerance -= 1
+
+
+def _skip_sequence_collection(fp):
+    # yields the content of a file without its SequenceCollection element,
+    # files opened in text mode are not searched
+    pending = b''
+    skipping = False
+    while True:
+        data = fp.read(STAT_CHUNK_SIZE)
+        if not data or isinstance(data, str):
+            if data:
+                yield data
+                yield from iter(lambda: fp.read(STAT_CHUNK_SIZE), '')
+            elif skipping:
+                # the collection started in the last chunk, the rest of the document follows its end
+                end = pending.find(_COLLECTION_END)
+                if end >= 0:
+                    yield pending[end + len(_COLLECTION_END):]
+            elif pending:
+                yield pending
+            return
+        data = pending + data
+        pending = b''
+
+        if skipping:
+            end = data.find(_COLLECTION_END)
+            if end < 0:
+                pending = data[-len(_COLLECTION_END):]
+                continue
+            yield data[end + len(_COLLECTION_END):]
+            yield from iter(lambda: fp.read(STAT_CHUNK_SIZE), b'')
+            return
+
+        start = data.find(_COLLECTION_START)
+        while start >= 0 and data[start + len(_COLLECTION_START):start + len(_COLLECTION_START) + 1] not in (b' ', b'>', b'\n', b'\r', b'\t'):
+            start = data.find(_COLLECTION_START, start + 1)
+
+        if start < 0 or data.find(b'>', start) < 0:
+            # a tag cut at the end of the chunk is completed by the next one
+            keep = len(data) - start if start >= 0 else len(_COLLECTION_START)
+            pending = data[-keep:]
+            yield data[:-keep]
+        elif data[data.find(b'>', start) - 1:data.find(b'>', start)] == b'/':
+            # an empty collection
+            end = data.find(b'>', start) + 1
+            yield data[:end]
+            pending = data[end:]
+        else:
+            yield data[:start]
+            pending = data[start:]
+            skipping = True
+
+
+def probe_tolerances(path):
+    """
+    Reads the fragment tolerances of an mzid without parsing its identifications.
+
+    Parameters
+    ----------
+    path: str
+        path to a plain or gzip compressed MZID
+
+    Returns
+    -------
+    tuple
+        search tolerance plus and minus values in dalton, None if the mzid has none or is malformed
+
+    """
+    try:
+        result = StatisticsHandler().parse(path)
+    except xml.parsers.expat.ExpatError:
+        return None
+    if not ('search tolerance plus value' in result and 'search tolerance minus value' in result):
+        return None
+    return result['search tolerance plus value'], result['search tolerance minus value']
+
 
-         
 if __name__ == '__main__':
-    with open("/home/dan/Documents/Work/PRIDEdata/xml_handlers/kelstrup_hela-res15000_all-fractions.out.cpsx.xml") as f:
-        print(StatisticsHandler().parse(f))
\ No newline at end of file
+    with open("/home/dan/Documents/Work/PRIDEdata/xml_handlers/kelstrup_hela-res15000_all-fractions.out.cpsx.xml", 'rb') as f:
+        print(StatisticsHandler().parse(f))
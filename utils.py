@@ -1,5 +1,47 @@
+import gzip
 import resource
 
+GZIP_MAGIC = b'\x1f\x8b'
+
+def is_gzip_file(path):
+    """ 
+    Checks if a file is gzip compressed 
+
+    Parameters
+    ----------
+    path: str
+        path to a file
+
+    Returns
+    -------
+    bool
+        True if the file starts with the gzip magic number
+
+    """
+    with open(path, 'rb') as fp:
+        return fp.read(2) == GZIP_MAGIC
+
+def open_file(path, mode='rb'):
+    """ 
+    Opens a plain or gzip compressed file for reading, compressed files are decompressed while reading 
+
+    Parameters
+    ----------
+    path: str
+        path to a plain or gzip compressed file
+    mode: str
+        'rb' for bytes or 'r' for text
+
+    Returns
+    -------
+    file
+        readable file object
+
+    """
+    if is_gzip_file(path):
+        return gzip.open(path, 'rt' if mode == 'r' else mode)
+    return open(path, mode)
+
 def memory_limit(ratio):
     """ 
     Limits this processes system memory to a fixed ratio 
@@ -1,12 +1,17 @@
 import sys
 import logging
 import csv
+import itertools
 import multiprocessing
 from functools import partial
 from multiprocessing import Pool
-from parsers.mgf_file import parse_mgf
+from parsers.mgf_index import iter_selected_spectra, open_spectra
 from parsers import mzid_handler
-from features.psm_features import FeatureList
+from parsers import mzid_parallel
+from parsers.statistics_handler import probe_tolerances
+from features.psm_features import ladder_cache, LADDER_CACHE_SIZE
+from features.batch_features import calculate_batch_features, FEATURE_BATCH_SIZE
+from accessors.manifest import Manifest, FEATURIZED, WRITTEN
 import math
 import os
 import time
@@ -48,44 +53,136 @@ def writeCSVHeader(csvPath, features):
         csvwriter = csv.DictWriter(csvfile, delimiter=',', fieldnames=features)
         csvwriter.writeheader()
 
-def generateRow(mzid, mgf, parameters, feature_list):
+def generateRows(psms, spectra, parameters, feature_list):
     """ 
-    Generates an individual row for csv from PSM 
+    Generates the csv rows of a batch of PSMs in one pass 
     
     Parameters
     ----------
-    mzid: _Result
-        mzid representation
-    mgf: dict
-        mgf representation
+    psms: list
+        mzid rows of the psms
+    spectra: list
+        mgf representation of every psm
     parameters: dict
-        parameters for a psm
+        parameters for the psms
+    feature_list: list
+        features written to the csv
 
     Returns
     -------
-    dict
-        representing a csv PSM row
+    list
+        dict representing a csv PSM row or None if no peaks matched, per psm
 
     """
+    if not psms:
+        return []
+    table = calculate_batch_features(psms, spectra, parameters['search tolerance plus value'], parameters['search tolerance minus value'])
+    return list(table.rows(feature_list))
+
+def splitLargeMZIDs(files, processes, parallel_mzid_size, spectra_source='index', parse_cache=None):
+    """ 
+    Parses large mzids in parallel and splits their PSMs into one task per process 
     
-    features = FeatureList(mzid, mgf, parameters['search tolerance plus value'], parameters['search tolerance minus value'])
-    
-    if features.calculate_features():
+    Parameters
+    ----------
+    files: list
+        file tuples of a project
+    processes: int
+        number of processes
+    parallel_mzid_size: int
+        mzids of at least this size in bytes are parsed in parallel, 0 disables it
+    spectra_source: str
+        'stream', 'index' or 'store', see iter_selected_spectra
+    parse_cache: ParseCache
+        cache of parsed mzids and spectra
 
-        row = dict()
-        for feature in feature_list:
-            row[feature] = features.dictionary[feature]
+    Returns
+    -------
+    list
+        (position of the file tuple, file tuple, parsed PSMs or None, spectra source) tasks
 
-        return row
-    else:
-        return None
+    """
+    tasks = []
+    for position, file_tuple in enumerate(files):
+        mzidfp = file_tuple[1]
+
+        if not (parallel_mzid_size and processes > 1 and os.path.getsize(mzidfp) >= parallel_mzid_size):
+            tasks.append((position, file_tuple, None, spectra_source))
+            continue
+
+        # mzids without tolerances are rejected by processFunction, they are not parsed here
+        if probe_tolerances(mzidfp) is None:
+            tasks.append((position, file_tuple, None, spectra_source))
+            continue
+
+        if parse_cache:
+            table, parameters = parse_cache.get('psm_table', mzidfp,
+                partial(mzid_parallel.parse_parallel, processes=processes), mzid_handler.PARSER_VERSION)
+        else:
+            table, parameters = mzid_parallel.parse_parallel(mzidfp, processes)
+
+        # the spectra are indexed once instead of by every task, an mgf
+        # which would be streamed by every task is converted to a store once
+        task_source = spectra_source
+        if parse_cache:
+            spectra = parse_cache.spectra(file_tuple[0])
+        else:
+            spectra = open_spectra(file_tuple[0], source=spectra_source)
+            if spectra is None:
+                task_source = 'store'
+                spectra = open_spectra(file_tuple[0], source=task_source)
+        spectra.close()
+
+        step = max(1, math.ceil(len(table) / processes))
+        for begin in range(0, max(len(table), 1), step):
+            tasks.append((position, file_tuple, (table.slice(begin, min(begin + step, len(table))), parameters), task_source))
+
+    return tasks
+
+def processTask(task, features, parse_cache=None, ladder_cache_size=LADDER_CACHE_SIZE, top_rank_only=False):
+    """ 
+    Data-parallel function generating CSV rows of a task created by splitLargeMZIDs 
+    """
+    _, files, parsed, spectra_source = task
+    ladder_cache.resize(ladder_cache_size)
+    return processFunction(files, features, spectra_source, parsed, parse_cache, top_rank_only)
+
+def writeCSVPSMSfromArchive(archivePath, maximalNumberofCores, features = [], csv_location = None, projects = None, spectra_source = 'index', parallel_mzid_size = 0, parse_cache = None, ladder_cache_size = LADDER_CACHE_SIZE, top_rank_only = False):
+    """ 
+    Writes PSMs to CSV from the extracted file tuples of the archive manifest 
+    
+    Parameters
+    ----------
+    archivePath: str
+        path to the archive manifest
+    maximalNumberofCores: int
+        maximal number of processes
+    features: list
+        features written to the csv
+    csv_location: str
+        path of a single csv for all projects
+    projects: list
+        restricts the csv to these projects
+    spectra_source: str
+        'stream', 'index' or 'store', see iter_selected_spectra
+    parallel_mzid_size: int
+        mzids of at least this size in bytes are parsed in parallel chunks, 0 disables it
+    parse_cache: ParseCache
+        cache of parsed mzids and spectra, repeated jobs skip parsing
+    ladder_cache_size: int
+        fragment ladders kept by every process, see LadderCache
+    top_rank_only: bool
+        only writes the rank 1 PSMs of each spectrum
+
+    Returns
+    -------
+    list
+        paths of the written csvs
 
-def writeCSVPSMSfromArchive(archivePath, maximalNumberofCores, features = [], csv_location = None):
-    """ Writes PSMs to CSV from Archive """
+    """
     archived_files = dict()
-    with open(archivePath, 'r') as fp:
-        csvreader = csv.reader(fp, delimiter=';')
-        for row in csvreader:
+    with Manifest(archivePath) as manifest:
+        for row in manifest.files(projects):
             if row[0] in archived_files:
                 archived_files[row[0]].append(row[1:])
             else:
@@ -104,25 +201,86 @@ def writeCSVPSMSfromArchive(archivePath, maximalNumberofCores, features = [], cs
         log.info(project_id)
 
         processes = min(multiprocessing.cpu_count(), maximalNumberofCores)
+        tasks = splitLargeMZIDs(archived_files[project_id], processes, parallel_mzid_size, spectra_source, parse_cache)
         with Pool(processes=processes) as p:
-            results = p.map(partial(processFunction, features=features), archived_files[project_id])
+            task_results = p.map(partial(processTask, features=features,
+                parse_cache=parse_cache, ladder_cache_size=ladder_cache_size, top_rank_only=top_rank_only), tasks)
+
+        # rows of split file tuples are joined in task order
+        results = [None] * len(archived_files[project_id])
+        for task, res in zip(tasks, task_results):
+            if res:
+                results[task[0]] = (results[task[0]] or []) + res
 
         if not csv_location:
             header_written = False
             csv_path = os.path.join(os.path.dirname(archivePath), str(project_id), str(project_id)+".csv")
             log.info('Writing CSV! {}'.format(csv_path))
         
-        for res in results:
-            if res:
-                if not header_written:
-                    writeCSVHeader(csv_path, features)
-                    csv_files.append(csv_path)
-                    header_written = True
-                writeCSVRows(res, csv_path, features)
+        with Manifest(archivePath) as manifest:
+            for files, res in zip(archived_files[project_id], results):
+                if res:
+                    manifest.set_file_state(project_id, files[0], files[1], FEATURIZED)
+                    if not header_written:
+                        writeCSVHeader(csv_path, features)
+                        csv_files.append(csv_path)
+                        header_written = True
+                    writeCSVRows(res, csv_path, features)
+                    manifest.set_file_state(project_id, files[0], files[1], WRITTEN)
 
     return csv_files
       
-def processFunction(files, features):
+def joinSpectra(psms, mgffp, spectra_source='index', spectra=None):
+    """ 
+    Joins streamed PSMs with their spectra 
+    
+    Parameters
+    ----------
+    psms: iterable
+        spectrum ids and PSMs
+    mgffp: str
+        path to the mgf
+    spectra_source: str
+        'stream', 'index' or 'store', see iter_selected_spectra
+    spectra: SpectrumStore
+        opened spectra used instead of the spectra source
+
+    Yields
+    ------
+    tuple
+        spectrum id, PSM and Spectrum or None if the spectrum is not in the mgf
+
+    """
+    if spectra is None:
+        spectra = open_spectra(mgffp, source=spectra_source)
+
+    if spectra is None:
+        # a streamed mgf is joined once all psms are parsed
+        mzid = dict()
+        for key, psm in psms:
+            mzid.setdefault(key, []).append(psm)
+
+        found = set()
+        for key, spectrum in iter_selected_spectra(mgffp, mzid, source=spectra_source):
+            found.add(key)
+            for psm in mzid[key]:
+                yield key, psm, spectrum
+
+        for key in mzid:
+            if key not in found:
+                for psm in mzid[key]:
+                    yield key, psm, None
+        return
+
+    with spectra:
+        # psms of a spectrum follow each other, the spectrum is read once for all of them
+        last_key = spectrum = None
+        for key, psm in psms:
+            if key != last_key:
+                last_key, spectrum = key, spectra.get(key)
+            yield key, psm, spectrum
+
+def processFunction(files, features, spectra_source='index', parsed=None, parse_cache=None, top_rank_only=False):
     """ 
     Data-parallel function generating CSV 
     
@@ -130,44 +288,90 @@ def processFunction(files, features):
     ----------
     files: list
         list of file tuples
+    features: list
+        features written to the csv
+    spectra_source: str
+        'stream', 'index' or 'store', see iter_selected_spectra
+    parsed: tuple
+        PSMTable and search parameters of an mzid parsed before, the mzid is streamed otherwise
+    parse_cache: ParseCache
+        cache of parsed mzids and spectra, the mzid is not streamed if a cache is used
+    top_rank_only: bool
+        only the rank 1 PSMs of each spectrum are written, all ranks otherwise
         
     """
     rows = []
     mgffp = files[0]
     mzidfp = files[1]
-    log.info('Processing MZID {}'.format(mzidfp))
-    mzid, parameters = mzid_handler.MZIdentMLHandler().parse(mzidfp)
+
+    if not parsed and parse_cache:
+        # a full parse of an mzid without tolerances is neither needed nor cached
+        if probe_tolerances(mzidfp) is None:
+            log.error('No tolerances found! {0}'.format(mzidfp))
+            return None
+        parsed = parse_cache.get('psm_table', mzidfp, mzid_parallel.parse_sequential, mzid_handler.PARSER_VERSION)
+
+    if parsed:
+        table, parameters = parsed
+        psms = ((psm.spectrum_id, psm) for psm in table)
+        first_psm = None
+    else:
+        log.info('Processing MZID {}'.format(mzidfp))
+        handler = mzid_handler.MZIdentMLHandler()
+        psms = handler.iter_results(mzidfp)
+
+        # search parameters precede the identifications
+        first_psm = next(psms, None)
+        parameters = handler.parameters
 
     if not ('search tolerance minus value' in parameters and 'search tolerance plus value' in parameters):
         log.error('No tolerances found! {0}'.format(mzidfp))
+        psms.close()
         return None
     
     else:
         log.info('Processing MGF {}'.format(mgffp))
-        mgf, _ = parse_mgf(mgffp)
+
+        if first_psm:
+            psms = itertools.chain([first_psm], psms)
+
+        if top_rank_only:
+            psms = ((key, psm) for key, psm in psms if psm.rank == 1)
 
         not_found_in_mgf = 0
         not_matching_pepmass = 0
         not_matching_peaks = 0
 
-        for key in mzid:
+        # features are calculated in batches while the mzid is parsed
+        batch_psms = []
+        batch_spectra = []
+        spectra = parse_cache.spectra(mgffp) if parse_cache else None
+        for key, mzid_dict, mgf_dict in itertools.chain(joinSpectra(psms, mgffp, spectra_source, spectra), [(None, None, None)]):
 
-            if key not in mgf:
-                not_found_in_mgf += 1
-                continue
+            if key is not None:
+                if mgf_dict is None:
+                    not_found_in_mgf += 1
+                    continue
 
-            if not (int(mgf[key]['pepmass']) == int(float(mzid[key].experimentalMassToCharge))):
-                not_matching_pepmass += 1
-                continue 
+                if not (int(mgf_dict.pepmass) == int(float(mzid_dict.experimentalMassToCharge))):
+                    not_matching_pepmass += 1
+                    continue 
 
-            mgf_dict = mgf[key]
-            mzid_dict = mzid[key]
-            #log.info("Calculating features for {}".format(key))
-            row = generateRow(mzid_dict, mgf_dict, parameters, features)
-            if row:
-                rows.append(row)
-            else:
-                not_matching_peaks += 1
+                batch_psms.append(mzid_dict)
+                batch_spectra.append(mgf_dict)
+                if len(batch_psms) < FEATURE_BATCH_SIZE:
+                    continue
+
+            for row in generateRows(batch_psms, batch_spectra, parameters, features):
+                if row:
+                    rows.append(row)
+                else:
+                    not_matching_peaks += 1
+            batch_psms = []
+            batch_spectra = []
+
+        log.info("Ladder cache: {0} ladders, {1} hits, {2} misses ({3:.1%} hit rate)".format(
+            len(ladder_cache), ladder_cache.hits, ladder_cache.misses, ladder_cache.hit_rate()))
 
         if not_found_in_mgf+not_matching_peaks+not_matching_pepmass > 0:
             log.warning("MZID: {0} Not found in MGF: {1} No matching peaks: {2} No matching pepmass: {3}".format(mzidfp, not_found_in_mgf, not_matching_peaks, not_matching_pepmass))
@@ -178,4 +382,4 @@ def processFunction(files, features):
 
 
 if __name__ == "__main__":
-    writeCSVPSMSfromArchive("data_pride/archive", 4)
+    writeCSVPSMSfromArchive("data_pride/archive.db", 4)
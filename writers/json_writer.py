@@ -1,6 +1,6 @@
 import jsonpickle
-import csv
-from parsers.mgf_file import parse_mgf
+from accessors.manifest import Manifest
+from parsers.mgf_index import iter_selected_spectra
 from parsers import mzid_handler
 
 
@@ -36,23 +36,31 @@ def writeJSONPSM(filename, psm):
         fp.write(jsonpickle.encode(psm, unpicklable=False))
 
 
-def writeJSONPSMSfromArchive(archivePath, jsonPath):
+def parseMZID(mzidfp):
+    """ 
+    Parses the PSMs of an mzid, one PSM for each spectrum 
+    """
+    return mzid_handler.MZIdentMLHandler().parse(mzidfp)
+
+
+def writeJSONPSMSfromArchive(archivePath, jsonPath, projects=None, parse_cache=None):
     """
     Generates and writes PSM Jsons 
     
     Parameters
     ----------
     archivePath: str
-        path to archive file
+        path to the archive manifest
     jsonPath: str
         path to json
+    projects: list
+        restricts the json to these projects
+    parse_cache: ParseCache
+        cache of parsed mzids and spectra, repeated jobs skip parsing
 
     """
-    archived_files = []
-    with open(archivePath, 'r') as fp:
-        csvreader = csv.reader(fp, delimiter=';')
-        for row in csvreader:
-            archived_files.append(row)
+    with Manifest(archivePath) as manifest:
+        archived_files = manifest.files(projects)
 
     print("Archived Files:")
     for files in archived_files:
@@ -62,12 +70,16 @@ def writeJSONPSMSfromArchive(archivePath, jsonPath):
     for files in archived_files:
         mgffp = files[1]
         mzidfp = files[2]
-        mzid = mzid_handler.MZIdentMLHandler().parse(mzidfp)
-        mgf, _ = parse_mgf(mgffp)
+        if parse_cache:
+            mzid, _ = parse_cache.get('mzid_results', mzidfp, parseMZID, mzid_handler.PARSER_VERSION)
+            mgf = dict(parse_cache.spectra(mgffp).iter_spectra(mzid))
+        else:
+            mzid, _ = parseMZID(mzidfp)
+            mgf = dict(iter_selected_spectra(mgffp, mzid))
         for key in mzid:
             if key in mgf:
-                if int(mgf[key]['pepmass']) == int(float(mzid[key]['pepmass'])):
-                    psms.append({'index': key, 'mgf': mgf[key],'mzid': mzid[key]})
+                if int(mgf[key].pepmass) == int(float(mzid[key].experimentalMassToCharge)):
+                    psms.append({'index': key, 'mgf': mgf[key].to_dict(),'mzid': mzid[key]})
                 else:
                     print("No matching pepmass: {}".format(key))
             else:
@@ -76,6 +88,6 @@ def writeJSONPSMSfromArchive(archivePath, jsonPath):
     writeJSONPSM(jsonPath, psms)
 
 if __name__ == "__main__":
-    archivePath = "data_pride/archive"
+    archivePath = "data_pride/archive.db"
     jsonPath = "test.json"
     writeJSONPSMSfromArchive(archivePath, jsonPath)
\ No newline at end of file
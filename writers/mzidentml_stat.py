@@ -1,10 +1,11 @@
-import xml
+import xml.parsers.expat
 import csv
-import gc
-import time
 import sys
+import multiprocessing
+from multiprocessing import Pool
 
-from xml_handlers import statistics_handler
+from parsers import statistics_handler
+from accessors.manifest import Manifest
 from utils import get_memory
 from utils import memory_limit
 
@@ -28,65 +29,68 @@ def write_csv(path, dictionary):
 
 def parse_stat_mzident(mzid_file):
     """ 
-    Parses MZID and generates statistics 
+    Scans the head of an MZID and generates statistics 
     
     Parameters
     ----------
     mzid_file: str
-        path to mzid file
+        path to a plain or gzip compressed mzid file
 
     Returns
     -------
     dict
         statistics dictionary
     """
-    print(mzid_file)
-    with open(mzid_file) as f:
-        return statistics_handler.StatisticsHandler().parse(f)
+    return statistics_handler.StatisticsHandler().parse(mzid_file)
 
-def main():
+def scan_file(files):
+    """ 
+    Scans the mzid of a file tuple, errors are returned instead of raised 
+
+    Returns
+    -------
+    tuple
+        file tuple, statistics dictionary or None and the error or None
+    """
+    try:
+        return files, parse_stat_mzident(files[2]), None
+    except (xml.parsers.expat.ExpatError, ValueError, KeyError, MemoryError, OSError) as err:
+        return files, None, err
+
+def count(stat, key):
+    stat[str(key)] = stat.get(str(key), 0) + 1
+
+def main(processes=None):
     memory_limit(0.8) # Limitates maximun memory usage to half
 
-    archived_files = []
-    with open('data_pride/archive', 'r') as fp:
-       csvreader = csv.reader(fp, delimiter=';')
-       for row in csvreader:
-           archived_files.append(row)
+    with Manifest('data_pride/archive.db') as manifest:
+        archived_files = manifest.files()
     it = 1
     params_stat = dict()
     software_stat = dict()
-    for files in archived_files:
+    score_params_stat = dict()
 
-        try:
-            print("Start Parsing!")
-            dictionary = parse_stat_mzident(files[2])
-            print("Finished Parsing!")
-        except (xml.etree.ElementTree.ParseError, ValueError, MemoryError) as err:
-            print("File is bad!")
-            print(files)
-            print(err)
-            print(err.args)
-            gc.collect()
-            time.sleep(5)
-            continue
+    processes = processes or multiprocessing.cpu_count()
+    print("Scanning {} files with {} processes!".format(len(archived_files), processes))
+    with Pool(processes=processes) as p:
+        for files, dictionary, err in p.imap_unordered(scan_file, archived_files, chunksize=16):
+            if err is not None:
+                print("File is bad!")
+                print(files)
+                print(err)
+                print(err.args)
+                continue
 
-        if str(dictionary['params']) in params_stat:
-            params_stat[str(dictionary['params'])] += 1
-        else:
-            params_stat[str(dictionary['params'])] = 1
+            count(params_stat, dictionary.get('params'))
+            count(software_stat, dictionary.get('software'))
+            count(score_params_stat, dictionary['score_params'])
 
-        if str(dictionary['software']) in software_stat:
-            software_stat[str(dictionary['software'])] += 1
-        else:
-            software_stat[str(dictionary['software'])] = 1
-
-        print()
-    
     write_csv('stats/' + str(it) + '_params_stat.csv', params_stat)
     write_csv('stats/' + str(it) + '_software_stat.csv', software_stat)
+    write_csv('stats/' + str(it) + '_score_params_stat.csv', score_params_stat)
 
 if __name__ == '__main__':
     try:
-        main()
+        main(int(sys.argv[1]) if len(sys.argv) > 1 else None)
     except Exception as err:
         print(err)